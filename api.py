@@ -8,6 +8,8 @@ import importlib
 from functools import wraps
 from collections import defaultdict, Counter
 import json
+import copy
+import hmac
 import re
 import traceback
 import datetime
@@ -15,8 +17,6 @@ import bson
 import tweepy
 import pymongo
 import urllib
-import lxml.html
-import nltk
 
 
 settings_module = os.environ.get('FLASK_SETTINGS_MODULE')
@@ -27,15 +27,37 @@ except ImportError as e:
     raise ImportError("Could not import settings module '%s': %s" % (settings_module, e))
 
 
-from twxplorer.connection import _search, _session, _tweets, _url, _list
-from twxplorer import extract, twutil
+from twxplorer.connection import _search, _session, _tweets, _tweet_store, \
+    _facets, _url, _list, pool_metrics
+from twxplorer import backends, cache, extract, facets, jobs, metrics, \
+    resolver, scheduler, sources, storage, twutil
 
 app = Flask(__name__)
 app.config.from_envvar('FLASK_SETTINGS_FILE')
 
 settings = sys.modules[settings_module]
 
-html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+extract_backend = backends.get_backend(
+    settings.EXTRACT_BACKEND, settings.EXTRACT_POOL_SIZE)
+
+analyze_jobs = jobs.JobQueue(
+    settings.ANALYZE_WORKERS, settings.ANALYZE_QUEUE_SIZE)
+
+metrics.configure(settings.METRICS_ENABLED, settings.METRICS_LOG_INTERVAL)
+
+fetch_scheduler = scheduler.FetchScheduler(
+    low_quota=settings.TWITTER_QUOTA_LOW,
+    low_limit=settings.TWITTER_SEARCH_LIMIT_LOW)
+
+url_resolver = resolver.Resolver(_url, workers=settings.URL_WORKERS,
+    per_host=settings.URL_PER_HOST, timeout=settings.URL_TIMEOUT,
+    negative_ttl=settings.URL_NEGATIVE_TTL, max_bytes=settings.URL_MAX_BYTES,
+    max_pending=settings.URL_MAX_PENDING)
+
+# username -> saved results and list map
+history_cache = cache.get_cache(settings.HISTORY_CACHE_URL,
+    settings.HISTORY_CACHE_SIZE, settings.HISTORY_CACHE_TTL)
 
 
 def is_logged_in():
@@ -186,7 +208,8 @@ def _require_session_owned(session_id):
     """
     Require that the session is owned by the logged in user
     """
-    session_r = _session.find_one({'_id': bson.ObjectId(session_id)})
+    session_r = _session.find_one({'_id': bson.ObjectId(session_id)},
+        {'facets': 0, 'tweet_ids': 0})
     if not session_r:
         raise Exception('Session not found')
 
@@ -203,7 +226,8 @@ def _require_session_access(session_id):
     """
     Require that the session is owned by the logged in user or shared
     """
-    session_r = _session.find_one({'_id': bson.ObjectId(session_id)})
+    session_r = _session.find_one({'_id': bson.ObjectId(session_id)},
+        {'facets': 0, 'tweet_ids': 0})
     if not session_r:
         raise Exception('Session not found')
 
@@ -217,10 +241,51 @@ def _require_session_access(session_id):
 
     return search_r['username']
 
+def _user_data_version(username):
+    """
+    Return current version of cached data for user, entries are stored
+    under it so that invalidation orphans them, including any written by
+    loads that started before
+    """
+    version = history_cache.get(username)
+    if version is None:
+        version = str(bson.ObjectId())
+        history_cache.set(username, version)
+    return version
+
+
+def _cached_user_data(key, f, *args):
+    """
+    Return f(*args) for logged in user, cached under key in history_cache
+    (each key in its own entry, f may load other keys meanwhile)
+    """
+    username = session['username']
+    cache_key = '%s:%s:%s' % (username, _user_data_version(username), key)
+    data = history_cache.get(cache_key)
+    if data is None:
+        data = f(*args)
+        history_cache.set(cache_key, data)
+    return data
+
+
+def _invalidate_user_data(username=None):
+    """
+    Drop cached saved results and list map for user
+    """
+    history_cache.delete(username or session['username'])
+
+
 def _get_list_map():
     """
     Return list map for logged in user (id => full_name)
     """
+    return _cached_user_data('list_map', _load_list_map)
+
+
+def _load_list_map():
+    """
+    Load list map for logged in user from the database
+    """
     list_r = _list.find_one({'username': session['username']})
     list_map = {}
     if list_r:
@@ -233,6 +298,14 @@ def _get_saved_results(params=None):
     """
     Get saved results matching params, grouped by search
     """
+    key = 'saved:' + json.dumps(params or {}, sort_keys=True)
+    return _cached_user_data(key, _load_saved_results, params)
+
+
+def _load_saved_results(params=None):
+    """
+    Load saved results matching params from the database
+    """
     search_by_query = []
     search_by_list = []
 
@@ -241,8 +314,27 @@ def _get_saved_results(params=None):
     search_q = {'username': session['username']}
     search_q.update(params or {})
 
-    search_cursor = _search.find(search_q, sort=[('query', pymongo.ASCENDING)])
-    for search_r in search_cursor:
+    with metrics.span('mongo.saved_results.searches'):
+        search_list = list(_search.find(search_q,
+            sort=[('query', pymongo.ASCENDING)]))
+
+    # Get saved sessions for all searches at once, newest first
+    sessions_by_search = defaultdict(list)
+    if search_list:
+        with metrics.span('mongo.saved_results.sessions'):
+            session_cursor = _session.find(
+                {
+                    'search_id': {'$in': [str(r['_id']) for r in search_list]},
+                    'saved': 1
+                },
+                projection=['_id', 'search_id', 'dt', 'shared'],
+                sort=[('dt', pymongo.DESCENDING)]
+            )
+            for session_r in session_cursor:
+                sessions_by_search[session_r.pop('search_id')] \
+                    .append(session_r)
+
+    for search_r in search_list:
         search_r['_id'] = str(search_r['_id'])
         search_r['sessions'] = []
 
@@ -251,16 +343,13 @@ def _get_saved_results(params=None):
                 or search_r.get('list_name') \
                 or '[unknown]'
 
-        session_cursor = _session.find(
-            {'search_id': search_r['_id'], 'saved': 1},
-            fields=['_id', 'dt', 'shared'],
-            sort=[('dt', pymongo.DESCENDING)]
-        )
-        for session_r in session_cursor:
+        for session_r in sessions_by_search[search_r['_id']]:
             session_r['_id'] = str(session_r['_id'])
-            session_r['dt'] = datetime.datetime \
-                .strptime(session_r['dt'], '%Y-%m-%dT%H:%M:%S.%f') \
-                .strftime('%b %d %Y %H:%M:%S')
+            dt = session_r['dt']
+            if not isinstance(dt, datetime.datetime):
+                # sessions created before dt was stored as a datetime
+                dt = datetime.datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%f')
+            session_r['dt'] = dt.strftime('%b %d %Y %H:%M:%S')
 
             search_r['sessions'].append(session_r)
 
@@ -362,9 +451,6 @@ def lists(session_id=''):
         saved_results = []
 
         if logged_in:
-            unused, saved_results = _get_saved_results(
-                {'list_id': {'$exists': True}})
-
             username = session.get('username')
             delta = datetime.timedelta(minutes=15)
             refresh = False
@@ -392,9 +478,15 @@ def lists(session_id=''):
 
                 list_r['dt'] = datetime.datetime.now()
                 list_r['lists'] = lists
-                list_r['_id'] = _list.save(list_r, manipulate=True)
+                if '_id' in list_r:
+                    _list.replace_one({'_id': list_r['_id']}, list_r)
+                else:
+                    _list.insert_one(list_r)
+                _invalidate_user_data(username)
 
             list_map = _get_list_map()
+            unused, saved_results = _get_saved_results(
+                {'list_id': {'$exists': True}})
 
         if session_id:
             _require_session_access(session_id)
@@ -429,6 +521,265 @@ def history():
         return render_template('history.html', error=str(e))
 
 
+# session fields written by _analyze_session
+_job_fields = ['status', 'heartbeat', 'progress', 'stem_map', 'tweet_count',
+    'max_id', 'facet_docs', 'tweet_ids']
+
+
+def _set_progress(session_r, **kwargs):
+    """
+    Update analyze job status and progress
+    """
+    params = {'heartbeat': datetime.datetime.now()}
+    session_r['heartbeat'] = params['heartbeat']
+    for k, v in kwargs.items():
+        if k in ('status', 'error'):
+            session_r[k] = v
+            params[k] = v
+        else:
+            session_r['progress'][k] = v
+            params['progress.'+k] = v
+    _session.update_one({'_id': session_r['_id']}, {'$set': params})
+
+
+def _job_stale(session_r):
+    """
+    Return True if the analyze job of session has not reported progress
+    for ANALYZE_STALE_SECONDS
+    """
+    if session_r.get('status') not in ('pending', 'running'):
+        return False
+    heartbeat = session_r.get('heartbeat') or session_r.get('dt')
+    if not isinstance(heartbeat, datetime.datetime):
+        return False
+    return datetime.datetime.now() - heartbeat > \
+        datetime.timedelta(seconds=settings.ANALYZE_STALE_SECONDS)
+
+
+def _session_expires():
+    """
+    Return expiry time for an unsaved session and its tweets, or None
+    (UTC, as compared by the TTL indexes)
+    """
+    if not settings.SESSION_TTL_DAYS:
+        return None
+    return datetime.datetime.utcnow() + \
+        datetime.timedelta(days=settings.SESSION_TTL_DAYS)
+
+
+def _stored_expires(session_r):
+    """Return expiry time of session as stored, or None"""
+    r = _session.find_one({'_id': session_r['_id']}, {'expires': 1})
+    return (r or {}).get('expires')
+
+
+def _load_facets(session_r):
+    """
+    Return facet index of session, stored or inline (older sessions), or
+    None if it has none
+    """
+    if session_r.get('facet_docs'):
+        with metrics.span('mongo.facets.find'):
+            return facets.load_index(_facets, str(session_r['_id']),
+                session_r['facet_docs'])
+    return session_r.get('facets')
+
+
+def _load_previous(previous_r):
+    """
+    Load tweets of previous session to carry over into a refresh, in the
+    order they were fetched, with their tokens (full storage) or with the
+    session fields that shared tweets do not store
+    """
+    if storage.get_storage(previous_r) == storage.SHARED:
+        tweet_list = storage.find_shared(_tweet_store, previous_r['tweet_ids'])
+        facet_index = _load_facets(previous_r)
+        if facet_index is None:
+            raise Exception('Facets of session %s not found' % \
+                previous_r['_id'])
+        hashtags = defaultdict(list)
+        for term, ordinals in facet_index['hashtags']:
+            for o in ordinals:
+                hashtags[o].append(term)
+        for tweet_dict in tweet_list:
+            tweet_dict['hashtags'] = hashtags[tweet_dict['ordinal']]
+            tweet_dict.setdefault('urls', [])
+    else:
+        tweet_list = list(_tweets.find({'session_id': str(previous_r['_id'])},
+            sort=[('ordinal', pymongo.ASCENDING)]))
+        for tweet_dict in tweet_list:
+            del tweet_dict['_id']
+            tweet_dict.pop('expires', None)     # set with the new session
+    return tweet_list
+
+
+def _analyze_session(session_r, source, language, stoptags, previous_r=None):
+    """
+    Fetch tweets from source, extract terms and store them with session
+    (runs on an analyze_jobs worker thread)
+
+    @previous_r     earlier session of the same search that source only
+                    fetches newer tweets than, its tweets are carried over
+    """
+    try:
+        session_id = str(session_r['_id'])
+        _set_progress(session_r, status='running')
+
+        stoplist = extract.get_stoplist(language)
+        if stoptags:
+            stoplist = stoplist.extend(stoptags)
+        stemmer = extract.get_stemmer(language)
+
+        extractor = extract.NgramExtractor(stemmer, stoplist)
+        tweet_storage = storage.get_storage(session_r)
+        tweet_list = []
+        batch = []
+        pending = []    # [(tweets, memo, future)]
+
+        def submit_batch(batch):
+            # Reuse formatting and extraction of tweets already stored
+            if tweet_storage == storage.SHARED:
+                with metrics.span('mongo.store.find'):
+                    memo = storage.load_memo(_tweet_store, batch, language)
+            else:
+                memo = [(t['tokens'], None) if 'tokens' in t else None \
+                    for t in batch]
+            for t in batch:
+                if 'embed' not in t:
+                    t['embed'] = twutil.format_text(t)
+            pending.append((batch, memo, extract_backend.submit(
+                [t.get('text', '') for t in batch], language, stoptags, memo)))
+
+        for tweet in metrics.iterate('analyze.fetch',
+        source.items(limit=settings.TWITTER_SEARCH_LIMIT)):
+            tweet_dict = twutil.tweepy_model_to_dict(tweet)
+
+            tweet_dict['session_id'] = session_id
+            tweet_dict['ordinal'] = len(tweet_list)
+
+            # Filter hashtags from query
+            # tweet_dict['hashtags'] = list(set(['#'+x['text'].lower() \
+            #    for x in tweet_dict['entities']['hashtags']]))
+            tweet_dict['hashtags'] = list(set([
+                    '#'+x['text'].lower() \
+                    for x in tweet_dict['entities']['hashtags'] \
+                    if x['text'].lower() not in stoptags
+                ]))
+
+            tweet_dict['urls'] = list(set([x['expanded_url'] \
+                for x in tweet_dict['entities']['urls']]))
+
+            tweet_list.append(tweet_dict)
+
+            # Extract while the next page is being fetched
+            batch.append(tweet_dict)
+            if len(batch) >= backends.BATCH_SIZE:
+                submit_batch(batch)
+                batch = []
+                _set_progress(session_r, fetched=len(tweet_list))
+
+        # Carry over tweets of the previous session
+        if previous_r is not None \
+        and len(tweet_list) < settings.TWITTER_SEARCH_LIMIT:
+            with metrics.span('analyze.previous'):
+                previous_list = _load_previous(previous_r)
+            id_set = set(t['id_str'] for t in tweet_list)
+            reused = 0
+            for tweet_dict in previous_list:
+                if len(tweet_list) >= settings.TWITTER_SEARCH_LIMIT:
+                    break
+                if tweet_dict['id_str'] in id_set:
+                    continue
+                tweet_dict['session_id'] = session_id
+                tweet_dict['ordinal'] = len(tweet_list)
+                tweet_list.append(tweet_dict)
+                reused += 1
+
+                batch.append(tweet_dict)
+                if len(batch) >= backends.BATCH_SIZE:
+                    submit_batch(batch)
+                    batch = []
+            _set_progress(session_r, reused=reused)
+            metrics.incr('analyze.reused', reused)
+
+        if batch:
+            submit_batch(batch)
+        _set_progress(session_r, fetched=len(tweet_list))
+
+        metrics.incr('analyze.tweets', len(tweet_list))
+
+        # Warm url titles, most linked first
+        if settings.URL_PREFETCH_LIMIT:
+            url_counts = Counter(u for t in tweet_list for u in t['urls'])
+            with metrics.span('analyze.prefetch'):
+                url_resolver.prefetch([u for u, n in \
+                    url_counts.most_common(settings.URL_PREFETCH_LIMIT)])
+
+        processed = 0
+        shared_items = []   # [(tweet, memo, stems per clause)]
+        for batch, memo, future in pending:
+            with metrics.span('analyze.extract'):
+                results = future.result()
+            for i, (tweet_dict, (tokens, clauses)) in \
+            enumerate(zip(batch, results)):
+                tweet_dict['tokens'] = tokens
+                extractor.add_clauses(clauses)
+                if tweet_storage == storage.SHARED:
+                    shared_items.append((tweet_dict, memo[i],
+                        [c[1] for c in clauses]))
+            processed += len(batch)
+            _set_progress(session_r, processed=processed)
+
+        # Resolve n-grams
+        with metrics.span('analyze.ngram'):
+            tweet_stems, session_r['stem_map'] = extractor.finish()
+        for tweet, stems in zip(tweet_list, tweet_stems):
+            tweet['stems'] = stems
+
+        # The session may have been saved (or unsaved) since the job
+        # started, and history_update only updates tweets stored then
+        expires = _stored_expires(session_r)
+
+        # Save tweets
+        if tweet_storage == storage.SHARED:
+            session_r['tweet_ids'] = [t['id_str'] for t in tweet_list]
+            if shared_items:
+                with metrics.span('mongo.store.save'):
+                    storage.save_shared(_tweet_store, session_id, language,
+                        shared_items)
+        elif tweet_list:
+            with metrics.span('mongo.tweets.insert'):
+                storage.insert(_tweets, tweet_list, tweet_storage, expires)
+
+        session_r['progress']['stored'] = len(tweet_list)
+        session_r['status'] = 'done'
+        session_r['heartbeat'] = datetime.datetime.now()
+        session_r['tweet_count'] = len(tweet_list)
+        if tweet_list:
+            session_r['max_id'] = max(tweet_list,
+                key=lambda t: int(t['id_str']))['id_str']
+        with metrics.span('analyze.facets'):
+            facet_index = facets.build_index(tweet_list)
+        with metrics.span('mongo.facets.insert'):
+            session_r['facet_docs'] = facets.save_index(_facets, session_id,
+                facet_index, expires)
+
+        current = _stored_expires(session_r)
+        if current != expires:
+            storage.set_expires(_tweets, session_id, tweet_storage, current)
+            facets.set_expires(_facets, session_id, current)
+
+        # Only the fields the job owns, saved/shared/expires may have been
+        # changed by history_update meanwhile
+        params = dict((k, session_r[k]) for k in _job_fields if k in session_r)
+        with metrics.span('mongo.session.save'):
+            _session.update_one({'_id': session_r['_id']}, {'$set': params})
+        session_r.pop('tweet_ids', None)
+    except Exception as e:
+        traceback.print_exc()
+        _set_progress(session_r, status='error', error=str(e))
+
+
 @app.route("/analyze/", methods=['GET', 'POST'])
 @login_required
 def analyze():
@@ -440,6 +791,9 @@ def analyze():
     @query = query string
         OR
     @list_id = list id
+
+    @refresh = 0 to fetch all tweets again, instead of only those newer
+        than a recent session of the same search
      """
     try:
         language = request.args.get('language') or 'en'
@@ -454,9 +808,6 @@ def analyze():
         else:
             raise Exception('No query or list specified')
 
-        # Get api object
-        api = tweepy.API(get_oauth())
-
         # Get/create search record
         param = {
             'username': session['username'],
@@ -473,197 +824,110 @@ def analyze():
                 search_r['query'] = query
             else:
                 search_r['list_name'] = list_map[list_id]
-            search_r['_id'] = _search.save(search_r, manipulate=True)
+            _search.insert_one(search_r)
+            _invalidate_user_data()
         search_id = str(search_r['_id'])
 
+        # Find recent session to refresh, if its tweets can be carried over
+        previous_r = None
+        if settings.ANALYZE_REFRESH_MINUTES \
+        and request.args.get('refresh') != '0':
+            delta = datetime.timedelta(minutes=settings.ANALYZE_REFRESH_MINUTES)
+            previous_r = _session.find_one(
+                {
+                    'search_id': search_id,
+                    'status': 'done',
+                    'max_id': {'$exists': True},
+                    'storage': {'$in': [storage.FULL, storage.SHARED]},
+                    'dt': {'$gte': datetime.datetime.now() - delta}
+                },
+                sort=[('dt', pymongo.DESCENDING)])
+        since_id = previous_r['max_id'] if previous_r else None
+
         # Create search session
         session_r = {
             'search_id': search_id,
-            'dt': datetime.datetime.now().isoformat(),
+            'dt': datetime.datetime.now(),
             'stem_counts': [],      # [[stem, post count]]
             'stem_map': {},         # {stem: [term, count]}
+            'status': 'pending',
+            'progress': {'fetched': 0, 'processed': 0, 'stored': 0},
+            'heartbeat': datetime.datetime.now(),
+            'storage': settings.TWEET_STORAGE
         }
-        session_r['_id'] = _session.save(session_r, manipulate=True)
-        session_id = str(session_r['_id'])
-
-        # Process tweets
-        stopwords = extract.get_stopwords(language).copy()
+        if previous_r:
+            session_r['refreshed_from'] = str(previous_r['_id'])
+        expires = _session_expires()
+        if expires:
+            session_r['expires'] = expires
+        _session.insert_one(session_r)
+
+        # Get tweets
         stoptags = set()
-        stemmer = extract.get_stemmer(language)
-        stem_map = defaultdict(Counter)
-        tweet_list = []
 
         if query:
             stoptags.update([x.lower().lstrip('#') for x in query_lower.split()])
-            stopwords.update(stoptags)
-            cursor = tweepy.Cursor(api.search, q=query, lang=language, \
-                count=100, result_type='recent', include_entities=True)
-        else:
-            cursor = tweepy.Cursor(api.list_timeline, list_id=list_id, \
-                count=100, include_entities=True)
-
-        for tweet in cursor.items(limit=settings.TWITTER_SEARCH_LIMIT):
-            tweet_dict = twutil.tweepy_model_to_dict(tweet)
-
-            tweet_dict['session_id'] = session_id
-            tweet_dict['embed'] = twutil.format_text(tweet_dict)
-            tweet_dict['tokens'] = extract.tokenize(tweet_dict['text'])
 
-            # Filter hashtags from query
-            # tweet_dict['hashtags'] = list(set(['#'+x['text'].lower() \
-            #    for x in tweet_dict['entities']['hashtags']]))
-            tweet_dict['hashtags'] = list(set([
-                    '#'+x['text'].lower() \
-                    for x in tweet_dict['entities']['hashtags'] \
-                    if x['text'].lower() not in stoptags
-                ]))
+        if settings.TWEET_SOURCE_FILE:
+            source = sources.FileSource(settings.TWEET_SOURCE_FILE,
+                since_id=since_id)
+        else:
+            source = sources.TweepySource(tweepy.API(get_oauth()),
+                query=query, list_id=list_id, language=language,
+                since_id=since_id)
 
-            tweet_dict['urls'] = list(set([x['expanded_url'] \
-                for x in tweet_dict['entities']['urls']]))
+        # Share the fetch with identical searches running at the same time
+        # (lists may be private, so only with the same user)
+        if query:
+            fetch_key = ('query', query_lower, language, since_id)
+        else:
+            fetch_key = ('list', list_id, session['username'], since_id)
+        source = fetch_scheduler.source(fetch_key, source)
+
+        # The job gets its own copy, it is updated from another thread
+        job_r = copy.deepcopy(session_r)
+        try:
+            analyze_jobs.submit(_analyze_session,
+                job_r, source, language, stoptags, previous_r)
+        except jobs.QueueFull:
+            _session.delete_one({'_id': session_r['_id']})
+            raise
+
+        if not analyze_jobs.workers:
+            session_r = job_r   # ran synchronously
+        return _jsonify(session=session_r)
+    except tweepy.TweepError as e:
+        traceback.print_exc()
+        return _jsonify(error=e.message[0]['message'])
+    except Exception as e:
+        traceback.print_exc()
+        return _jsonify(error=str(e))
 
-            tweet_list.append(tweet_dict)
 
-        # ------------------------------------------------------------
-        # Process trigrams
-
-        trigram_counter = Counter()
-
-        for tweet in tweet_list:
-            grams = []
-
-            for tokens in tweet['tokens']:
-                for g in nltk.ngrams(tokens, 3):
-                    if extract.stoplist_iter(g, stopwords):
-                        continue
-                    if g[0].startswith('@') or g[1].startswith('@') or g[2].startswith('@'):
-                        continue
-                    grams.append(g)
-
-            stems = extract.stems_from_grams(grams, stemmer)
-            for s, g in zip(stems, grams):
-                stem_map[s].update([g])
-
-            tweet['stems_3'] = list(set(stems))
-            trigram_counter.update(tweet['stems_3'])
-
-        # Ignore trigrams that only appear once
-        items = list(trigram_counter.items())
-        for g, n in items:
-            if n < 2:
-                del trigram_counter[g]
-                del stem_map[g]
-
-        # ------------------------------------------------------------
-        # Process bigrams
-
-        bigram_counter = Counter()
-
-        for tweet in tweet_list:
-            grams = []
-            stems = []
-
-            for tokens in tweet['tokens']:
-                gram_list = list(nltk.ngrams(tokens, 2))
-                stem_list = extract.stems_from_grams(gram_list, stemmer)
-
-                last_i = len(gram_list) - 1
-
-                for i, g in enumerate(gram_list):
-                    if extract.stoplist_iter(g, stopwords):
-                        continue
-                    if g[0].startswith('@') or g[1].startswith('@'):
-                        continue
-
-                    # Filter by trigrams
-                    if i > 0 and \
-                    (stem_list[i-1][0], stem_list[i][0], stem_list[i][1]) in trigram_counter:
-                        continue
-                    if i < last_i and \
-                    (stem_list[i][0], stem_list[i][1], stem_list[i+1][1]) in trigram_counter:
-                        continue
-
-                    grams.append(g)
-                    stems.append(stem_list[i])
-
-            for s, g in zip(stems, grams):
-                stem_map[s].update([g])
-
-            tweet['stems_2'] = list(set(stems))
-            bigram_counter.update(tweet['stems_2'])
-
-        # Ignore bigrams that only appear once
-        items = list(bigram_counter.items())
-        for g, n in items:
-            if n < 2:
-                del bigram_counter[g]
-                del stem_map[g]
-
-        # ------------------------------------------------------------
-        # Process unigrams
-
-        for tweet in tweet_list:
-            grams = []
-            stems = []
-
-            for tokens in tweet['tokens']:
-                gram_list = list(nltk.ngrams(tokens, 1))
-                stem_list = extract.stems_from_grams(gram_list, stemmer)
-
-                last_i = len(gram_list) - 1
-
-                for i, g in enumerate(gram_list):
-                    if extract.stoplist_iter(g, stopwords):
-                        continue
-
-                    # Filter bigram terms
-                    if i > 0 and \
-                    (stem_list[i-1][0], stem_list[i][0]) in bigram_counter:
-                        continue
-                    if i < last_i and \
-                    (stem_list[i][0], stem_list[i+1][0]) in bigram_counter:
-                        continue
-
-                    # Filter trigram terms
-                    if i > 1 and \
-                    (stem_list[i-2][0], stem_list[i-1][0], stem_list[i][0]) in trigram_counter:
-                        continue
-                    if i > 0 and i < last_i and \
-                    (stem_list[i-1][0], stem_list[i][0], stem_list[i+1][0]) in trigram_counter:
-                        continue
-                    if i < (last_i - 1) and \
-                    (stem_list[i][0], stem_list[i+1][0], stem_list[i+2][0]) in trigram_counter:
-                        continue
-
-                    grams.append(g)
-                    stems.append(stem_list[i])
-
-            for s, g in zip(stems, grams):
-                stem_map[s].update([g])
-
-            # Process stems
-            tweet['stems'] = [' '.join(x) for x in set(stems)]
-            tweet['stems'].extend([' '.join(x) for x in tweet['stems_2'] if x in bigram_counter])
-            tweet['stems'].extend([' '.join(x) for x in tweet['stems_3'] if x in trigram_counter])
-
-            del tweet['stems_2']
-            del tweet['stems_3']
-
-        # Update session
-        for stem, c in stem_map.items():
-            session_r['stem_map'][' '.join(stem)] = \
-                [' '.join(k) for k, v in c.most_common()]
+@app.route("/analyze/status/<session_id>/", methods=['GET', 'POST'])
+@login_required
+def analyze_status(session_id):
+    """
+    Get status and progress of analyze job
+    """
+    try:
+        search_r, session_r = _require_session_owned(session_id)
 
-        # Save tweets
-        if tweet_list:
-            _tweets.insert(tweet_list)
+        if _job_stale(session_r):
+            # lost with a restarted worker, or stuck
+            _session.update_one(
+                {'_id': session_r['_id'], 'status': session_r['status']},
+                {'$set': {'status': 'error',
+                    'error': 'Search was interrupted, please try again'}})
+            session_r = _session.find_one({'_id': session_r['_id']},
+                {'facets': 0, 'tweet_ids': 0})
 
-        session_r['tweet_count'] = len(tweet_list)
-        _session.save(session_r)
+        if session_r.get('status') == 'error':
+            raise Exception(session_r.get('error') or 'Search failed')
 
+        session_r.setdefault('status', 'done')
+        session_r.pop('stem_map', None)
         return _jsonify(session=session_r)
-    except tweepy.TweepError as e:
-        traceback.print_exc()
-        return _jsonify(error=e.message[0]['message'])
     except Exception as e:
         traceback.print_exc()
         return _jsonify(error=str(e))
@@ -682,19 +946,31 @@ def filter(session_id):
     try:
         _require_session_access(session_id)
 
-        session_r = _session.find_one(
-            {'_id': bson.ObjectId(session_id)})
+        # Facets never change once stored, so skip them if already cached
+        engine = facets.get_engine(session_id)
+
+        with metrics.span('mongo.filter.session'):
+            session_r = _session.find_one(
+                {'_id': bson.ObjectId(session_id)},
+                {'facets': 0} if engine else None)
         if not session_r:
             raise Exception('Session not found')
 
-        search_r = _search.find_one(
-            {'_id': bson.ObjectId(session_r['search_id'])})
+        tweet_ids = session_r.pop('tweet_ids', None)
+        if not engine:
+            facet_index = _load_facets(session_r)
+            if facet_index:
+                with metrics.span('filter.facets.load'):
+                    engine = facets.set_engine(session_id, facet_index)
+        session_r.pop('facets', None)
+        session_r.pop('facet_docs', None)
+
+        with metrics.span('mongo.filter.search'):
+            search_r = _search.find_one(
+                {'_id': bson.ObjectId(session_r['search_id'])})
         if not search_r:
             raise Exception('Search not found')
 
-        # Find tweets
-        params = {'session_id': session_id}
-
         filter = request.args.getlist('filter[]')
         filter_stems = []
         filter_hashtags = []
@@ -708,39 +984,75 @@ def filter(session_id):
             else:
                 filter_stems.append(element)
 
-        if filter_urls:
-            params['urls'] = {'$all': filter_urls}
-        if filter_stems:
-            params['stems'] = {'$all': filter_stems}
-        if filter_hashtags:
-            params['hashtags'] = {'$all': filter_hashtags}
-
-        cursor = _tweets.find(params, {
-                'embed': 1,
-                'id_str': 1,
-                'created_at': 1,
-                'user.name': 1,
-                'user.screen_name': 1,
-                'retweeted_status.id_str': 1,
-                'stems': 1,
-                'hashtags': 1,
-                'urls': 1
-            }, sort=[('dt', pymongo.DESCENDING)])
+        # Find tweets
+        tweet_storage = storage.get_storage(session_r)
+        params = {}
+        fields = {
+            'embed': 1,
+            'id_str': 1,
+            'created_at': 1,
+            'user.name': 1,
+            'user.screen_name': 1,
+            'retweeted_status.id_str': 1
+        }
+
+        if engine:
+            # Answer from facet engine, only load tweets for display
+            with metrics.span('filter.facets.select'):
+                matched, counts = engine.select({
+                    'stems': filter_stems,
+                    'hashtags': filter_hashtags,
+                    'urls': filter_urls
+                })
+            with metrics.span('mongo.filter.tweets'):
+                if tweet_storage == storage.SHARED:
+                    cursor = storage.find_shared(_tweet_store, tweet_ids,
+                        matched)
+                else:
+                    if matched is not None:
+                        params['ordinal'] = {'$in': matched}
+                    cursor = storage.find(_tweets, session_id,
+                        tweet_storage, params, fields,
+                        sort=[('ordinal', pymongo.ASCENDING)])
+
+            stem_counts = counts['stems']
+            hashtag_counts = counts['hashtags']
+            url_counts = counts['urls']
+        else:
+            if filter_urls:
+                params['urls'] = {'$all': filter_urls}
+            if filter_stems:
+                params['stems'] = {'$all': filter_stems}
+            if filter_hashtags:
+                params['hashtags'] = {'$all': filter_hashtags}
+
+            fields.update({'stems': 1, 'hashtags': 1, 'urls': 1})
+            with metrics.span('mongo.filter.tweets'):
+                cursor = storage.find(_tweets, session_id, tweet_storage,
+                    params, fields, sort=[('ordinal', pymongo.ASCENDING)])
+
+            stem_counter = Counter()
+            hashtag_counter = Counter()
+            url_counter = Counter()
+
+            for tweet in cursor:
+                stem_counter.update(tweet['stems'])
+                hashtag_counter.update(tweet['hashtags'])
+                url_counter.update(tweet['urls'])
+
+            stem_counts = [x for x in stem_counter.most_common() \
+                if x[0] not in filter_stems]
+            hashtag_counts = [x for x in hashtag_counter.most_common() \
+                if x[0] not in filter_hashtags]
+            url_counts = [x for x in url_counter.most_common() \
+                if x[0] not in filter_urls]
 
         # Process tweets
-        stem_counter = Counter()
-        hashtag_counter = Counter()
-        url_counter = Counter()
-
         tweets = []
         retweets = 0
         id_set = set()
 
         for tweet in cursor:
-            stem_counter.update(tweet['stems'])
-            hashtag_counter.update(tweet['hashtags'])
-            url_counter.update(tweet['urls'])
-
             if tweet['id_str'] in id_set:
                 retweets += 1
                 continue
@@ -761,13 +1073,6 @@ def filter(session_id):
                 'created_at': tweet['created_at']
             })
 
-        stem_counts = [x for x in stem_counter.most_common() \
-            if x[0] not in filter_stems]
-        hashtag_counts = [x for x in hashtag_counter.most_common() \
-            if x[0] not in filter_hashtags]
-        url_counts = [x for x in url_counter.most_common() \
-            if x[0] not in filter_urls]
-
         return _jsonify(
             search=search_r,
             session=session_r,
@@ -808,8 +1113,20 @@ def history_update(session_id):
                     url_for('lists', session_id=str(session_r['_id']))
                 ))
 
-        _session.update({'_id': bson.ObjectId(session_id)},
-            {'$set': params}, multi=False)
+        update = {'$set': params}
+        if 'saved' in params:
+            # Saved sessions are kept, unsaved ones expire again
+            expires = None if params['saved'] else _session_expires()
+            if expires:
+                update['$set'] = dict(params, expires=expires)
+            else:
+                update['$unset'] = {'expires': 1}
+            storage.set_expires(_tweets, session_id,
+                storage.get_storage(session_r), expires)
+            facets.set_expires(_facets, session_id, expires)
+
+        _session.update_one({'_id': bson.ObjectId(session_id)}, update)
+        _invalidate_user_data()
 
         return _jsonify(**params)
     except Exception as e:
@@ -868,12 +1185,13 @@ def history_delete():
         session_ids.update([str(r['_id']) for r in cursor])
         session_ids = list(session_ids)
 
-        _tweets.remove(
-            {'session_id': {'$in': session_ids}})
-        _session.remove(
+        storage.remove_session(_tweets, session_ids, _tweet_store)
+        facets.remove_index(_facets, session_ids)
+        _session.delete_many(
             {'_id': {'$in': [bson.ObjectId(x) for x in session_ids]}})
-        _search.remove(
+        _search.delete_many(
             {'_id': {'$in': [bson.ObjectId(x) for x in search_ids]}})
+        _invalidate_user_data()
 
         return _jsonify(deleted=session_ids)
     except Exception as e:
@@ -894,22 +1212,7 @@ def urls():
         if not urls:
             raise Exception('No urls found')
 
-        info = []
-        for url in urls:
-            r = _url.find_one({'url': url})
-            if not r:
-                r = {'url': url, 'title': ''}
-                try:
-                    resp = urllib.request.urlopen(url, timeout=5)
-                    element = lxml.html.parse(resp, html_parser)
-                    if element:
-                        r['title'] = element.find(".//title").text.strip()
-                except Exception as e:
-                    pass
-
-                r['_id'] = _url.insert(r, manipulate=True)
-
-            info.append(r)
+        info = url_resolver.resolve(urls, deadline=settings.URL_DEADLINE)
 
         return _jsonify(info=info)
     except Exception as e:
@@ -917,6 +1220,32 @@ def urls():
         return _jsonify(error=str(e))
 
 
+@app.route("/metrics/", methods=['GET'])
+def metrics_view():
+    """
+    Get timing histograms and counters (METRICS_TOKEN or direct local
+    requests only)
+    """
+    if settings.METRICS_TOKEN:
+        token = request.headers.get('X-Metrics-Token') \
+            or request.args.get('token', '')
+        allowed = hmac.compare_digest(token.encode('utf-8'),
+            settings.METRICS_TOKEN.encode('utf-8'))
+    else:
+        # nginx proxies from localhost too, but sets the forwarding headers
+        allowed = request.remote_addr in ('127.0.0.1', '::1') \
+            and 'X-Forwarded-For' not in request.headers \
+            and 'X-Real-IP' not in request.headers
+    if not allowed:
+        return _jsonify(error='Not found'), 404
+    data = metrics.snapshot()
+    data['enabled'] = metrics.enabled
+    data['stemmers'] = dict((k, {'hits': v.hits, 'misses': v.misses}) \
+        for k, v in extract.stemmers.items())
+    data['mongo_pool'] = pool_metrics.snapshot()
+    return _jsonify(**data)
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, use_debugger=True, debug=True)
 
@@ -0,0 +1,532 @@
+'''
+Benchmark analyze, filter and urls on synthetic sessions.
+
+Runs the Flask app through its test client against a local mongo
+database named <DB_NAME__DEFAULT>_bench, which is dropped before and after
+the run, or against the in-memory engine to time the app without mongo.
+Tweets are replayed from a generated JSONL file and urls point at a local
+http server, so no twitter or network access is needed.
+
+Usage:
+    python <script> [options]
+
+Options:
+    -h, --help
+        Print this help information
+
+    -n=<n>, --tweets=<n>
+        Tweets per session (default = 500)
+
+    -s=<n>, --sessions=<n>
+        Number of sessions to analyze (default = 5)
+
+    -r=<n>, --requests=<n>
+        Number of filter and urls requests per session (default = 20)
+
+    -l=<code>, --language=<code>
+        Language code (default = en)
+
+    --hashtags=<x>
+        Average hashtags per tweet (default = 0.5)
+
+    --urls=<x>
+        Average urls per tweet (default = 0.3)
+
+    --retweets=<x>
+        Fraction of tweets that are retweets (default = 0.2)
+
+    --storage=<format>
+        Tweet storage format, full, compact or shared (default = full)
+
+    --engine=<engine>
+        Database engine, mongo or memory (default = mongo)
+
+    -o=<file>, --output=<file>
+        Write JSON results to file (default = stdout)
+'''
+import sys
+import getopt
+import os
+import json
+import random
+import time
+import datetime
+import resource
+import tempfile
+import threading
+import http.server
+
+# Import settings module
+if __name__ == "__main__":
+    if not os.environ.get('FLASK_SETTINGS_MODULE', ''):
+        os.environ['FLASK_SETTINGS_MODULE'] = 'core.settings'
+    if not os.environ.get('FLASK_SETTINGS_FILE', ''):
+        os.environ['FLASK_SETTINGS_FILE'] = os.path.abspath('core/settings.py')
+
+    for k, v in [
+        ('FLASK_SECRET_KEY', 'bench'),
+        ('STATIC_URL', '/'),
+        ('DB_ENGINE__DEFAULT', 'mongo'),
+        ('DB_NAME__DEFAULT', 'twxplorer'),
+        ('DB_HOST__DEFAULT', 'localhost'),
+        ('DB_PORT__DEFAULT', '27017'),
+        ('TWITTER_CONSUMER_KEY', ''),
+        ('TWITTER_CONSUMER_SECRET', ''),
+        ('BITLY_USERNAME', ''),
+        ('BITLY_APIKEY', ''),
+        ('BITLY_DOMAIN', ''),
+        # urls_cold measures uncached fetches, set to prefetch at analyze
+        ('URL_PREFETCH_LIMIT', '0'),
+        # every session fetches all tweets, set to time refreshes
+        ('ANALYZE_REFRESH_MINUTES', '0')]:
+        os.environ.setdefault(k, v)
+
+    # never touch the real database
+    os.environ['DB_NAME__DEFAULT'] += '_bench'
+
+    # run analyze in the request so its latency covers the whole job
+    os.environ['ANALYZE_WORKERS'] = '0'
+
+    # collect per-stage spans from the app
+    os.environ['METRICS_ENABLED'] = 'true'
+    os.environ['METRICS_LOG_INTERVAL'] = '0'
+
+
+#
+# Synthetic data
+#
+
+_syllables = ['ka', 'ro', 'mi', 'tan', 'le', 'su', 'vo', 'ni', 'pre', 'dal',
+    'ing', 'ed', 'er', 'ly', 'con', 'ta', 'bi', 'mor', 'es', 'un']
+
+
+def make_vocabulary(rnd, n):
+    """Return list of n distinct pseudo-words"""
+    words = set()
+    while len(words) < n:
+        words.add(''.join(rnd.choice(_syllables) \
+            for i in range(rnd.randint(1, 4))))
+    return sorted(words)
+
+
+def make_statuses(n, language, hashtag_density, url_density, retweet_ratio,
+    url_base, seed=0):
+    """
+    Generate n twitter api status objects
+    """
+    from twxplorer import extract
+
+    rnd = random.Random(seed)
+    vocab = make_vocabulary(rnd, 2000)
+    vocab.extend(sorted(extract.get_stopwords(language)))
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    tags = make_vocabulary(rnd, 100)
+    users = ['user%d' % i for i in range(max(10, n // 10))]
+    urls = ['%s/page/%d' % (url_base, i) for i in range(max(10, n // 20))]
+    dt = datetime.datetime(2014, 1, 1)
+
+    statuses = []
+    for i in range(n):
+        if statuses and rnd.random() < retweet_ratio:
+            original = rnd.choice(statuses)
+            original = original.get('retweeted_status', original)
+            status = dict(original)
+            status['retweeted_status'] = original
+            status['text'] = 'RT @%s: %s' % \
+                (original['user']['screen_name'], original['text'])
+            status['entities'] = dict(original['entities'])
+            status['entities']['user_mentions'] = \
+                [{'screen_name': original['user']['screen_name']}] + \
+                original['entities']['user_mentions']
+        else:
+            words = rnd.choices(vocab, weights, k=rnd.randint(5, 20))
+            mentions = [rnd.choice(users) for x in range(rnd.randint(0, 1))]
+            hashtags = [rnd.choice(tags) \
+                for x in range(int(rnd.expovariate(1.0 / hashtag_density)) \
+                    if hashtag_density else 0)]
+            links = [rnd.choice(urls) \
+                for x in range(int(rnd.expovariate(1.0 / url_density)) \
+                    if url_density else 0)]
+
+            text = ' '.join(['@'+x for x in mentions] + words)
+            text += rnd.choice(['.', ',', '!', ''])
+            text += ''.join(' #'+x for x in hashtags)
+            text += ''.join(' http://t.co/%d' % j for j in range(len(links)))
+
+            status = {
+                'text': text,
+                'lang': language,
+                'entities': {
+                    'hashtags': [{'text': x} for x in hashtags],
+                    'urls': [{'url': 'http://t.co/%d' % j, 'expanded_url': x}
+                        for j, x in enumerate(links)],
+                    'user_mentions': [{'screen_name': x} for x in mentions]
+                }
+            }
+
+        status['id'] = 1000000 + n - i
+        status['id_str'] = str(status['id'])
+        status['created_at'] = (dt - datetime.timedelta(seconds=i)) \
+            .strftime('%a %b %d %H:%M:%S +0000 %Y')
+        screen_name = rnd.choice(users)
+        status['user'] = {
+            'id_str': screen_name[4:],
+            'name': screen_name.title(),
+            'screen_name': screen_name
+        }
+        statuses.append(status)
+    return statuses
+
+
+class _PageHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a small html page with a title for any path"""
+    def do_GET(self):
+        body = ('<html><head><title>Page %s</title></head><body>%s</body>'
+            '</html>' % (self.path, 'lorem ipsum ' * 200)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_page_server():
+    """Start local http server in a thread, return its base url"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PageHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+#
+# Measurement
+#
+
+def percentile(values, p):
+    """Return p-th percentile of values (nearest rank)"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def summarize(latencies, elapsed):
+    """Return latency summary in ms"""
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None
+    }
+
+
+def timed(client, url, params):
+    """Issue GET request, return (seconds, json data)"""
+    t = time.perf_counter()
+    resp = client.get(url, query_string=params)
+    elapsed = time.perf_counter() - t
+    data = json.loads(resp.data.decode('utf-8'))
+    if 'error' in data:
+        raise Exception('%s: %s' % (url, data['error']))
+    return (elapsed, data)
+
+
+def run_requests(client, requests):
+    """Run list of (url, params), return (latencies, summary, responses)"""
+    latencies = []
+    responses = []
+    t = time.perf_counter()
+    for url, params in requests:
+        elapsed, data = timed(client, url, params)
+        latencies.append(elapsed)
+        responses.append(data)
+    return (latencies, summarize(latencies, time.perf_counter() - t),
+        responses)
+
+
+def history_timings(client, sizes, requests=10):
+    """
+    Time the history page as the number of saved searches grows
+    @return     {number of searches: summary}
+    """
+    from twxplorer.connection import _search, _session
+    import api
+
+    results = {}
+    n = 0
+    for size in sizes:
+        while n < size:
+            search_id = _search.insert_one({
+                'username': 'bench',
+                'language': 'en',
+                'query': 'saved %d' % n,
+                'query_lower': 'saved %d' % n
+            }).inserted_id
+            _session.insert_many([{
+                'search_id': str(search_id),
+                'dt': datetime.datetime.now(),
+                'saved': 1
+            } for i in range(2)])
+            n += 1
+        # searches were added behind the app's back
+        api.history_cache.delete('bench')
+
+        latencies = []
+        t = time.perf_counter()
+        for i in range(requests):
+            start = time.perf_counter()
+            resp = client.get('/history/')
+            latencies.append(time.perf_counter() - start)
+            if resp.status_code != 200:
+                raise Exception('/history/: status %d' % resp.status_code)
+        results[str(size)] = summarize(latencies, time.perf_counter() - t)
+    return results
+
+
+def stage_timings(statuses, language, stoptags):
+    """
+    Time the analyze stages directly on the corpus
+    @return     {stage: seconds}
+    """
+    from twxplorer import extract, facets, twutil
+    from twxplorer.connection import _db
+    from tweepy.models import Status
+
+    timings = {}
+
+    t = time.perf_counter()
+    tweet_list = [twutil.tweepy_model_to_dict(Status.parse(None, s)) \
+        for s in statuses]
+    for tweet in tweet_list:
+        tweet['embed'] = twutil.format_text(tweet)
+    timings['format'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    tokens = [extract.tokenize(tweet['text']) for tweet in tweet_list]
+    timings['tokenize'] = time.perf_counter() - t
+
+    stemmer = extract.get_stemmer(language)
+    stemmer.cache_clear()
+    stoplist = extract.get_stoplist(language).extend(stoptags)
+    t = time.perf_counter()
+    clauses = [extract.prepare(x, stemmer, stoplist) for x in tokens]
+    timings['stem'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    extractor = extract.NgramExtractor(stemmer, stoplist)
+    for x in clauses:
+        extractor.add_clauses(x)
+    tweet_stems, stem_map = extractor.finish()
+    timings['ngram'] = time.perf_counter() - t
+
+    for i, (tweet, x, stems) in \
+    enumerate(zip(tweet_list, tokens, tweet_stems)):
+        tweet['ordinal'] = i
+        tweet['tokens'] = x
+        tweet['stems'] = stems
+        tweet['hashtags'] = list(set(['#'+h['text'].lower() \
+            for h in tweet['entities']['hashtags']]))
+        tweet['urls'] = list(set([u['expanded_url'] \
+            for u in tweet['entities']['urls']]))
+
+    t = time.perf_counter()
+    _db['bench_insert'].insert_many(tweet_list, ordered=False)
+    timings['insert'] = time.perf_counter() - t
+    _db['bench_insert'].drop()
+
+    index = facets.build_index(tweet_list)
+    engine = facets.FacetEngine(index)
+    t = time.perf_counter()
+    for term, n in engine.counts['stems'][:50]:
+        engine.select({'stems': [term]})
+    timings['facet_count'] = (time.perf_counter() - t) / 50
+
+    return dict((k, round(v * 1000, 3)) for k, v in timings.items())
+
+
+def run_benchmark(opts):
+    """Run benchmark, return results"""
+    import api      # imports the settings module
+    from twxplorer import indexes, metrics, sources
+    from twxplorer.connection import _conn, _db
+
+    rnd = random.Random(1)
+    url_base = start_page_server()
+    query = 'bench'
+    statuses = make_statuses(opts['tweets'], opts['language'],
+        opts['hashtags'], opts['urls'], opts['retweets'], url_base)
+
+    corpus = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+    corpus.close()
+    sources.write_statuses(corpus.name, statuses)
+
+    api.settings.TWEET_SOURCE_FILE = corpus.name
+    api.settings.TWITTER_SEARCH_LIMIT = opts['tweets']
+    api.settings.TWEET_STORAGE = opts['storage']
+    opts['engine'] = api.settings.DATABASES['default']['ENGINE']
+    api.app.config['TESTING'] = True
+
+    _conn.drop_database(_db.name)
+    indexes.create_indexes(_db)
+    try:
+        client = api.app.test_client()
+        with client.session_transaction() as sess:
+            sess['request_token'] = 'bench'
+            sess['request_token_secret'] = 'bench'
+            sess['access_token'] = 'bench'
+            sess['access_token_secret'] = 'bench'
+            sess['username'] = 'bench'
+
+        results = {
+            'dt': datetime.datetime.now().isoformat(),
+            'options': opts
+        }
+
+        # analyze
+        latencies, results['analyze'], responses = run_requests(client,
+            [('/analyze/', {'query': query, 'language': opts['language']}) \
+                for i in range(opts['sessions'])])
+        session_ids = [r['session']['_id'] for r in responses]
+
+        # bytes stored per session tweet, in either tweets collection
+        tweet_count = sum(r['session']['tweet_count'] for r in responses)
+        tweet_bytes = 0
+        for name in ['tweets', 'tweet_store']:
+            if name in _db.list_collection_names():
+                tweet_bytes += _db.command('collstats', name)['size']
+        results['tweets_storage'] = {
+            'count': tweet_count,
+            'bytes': tweet_bytes,
+            'bytes_per_tweet': \
+                round(tweet_bytes / tweet_count) if tweet_count else 0
+        }
+
+        # filter
+        requests = []
+        for session_id in session_ids:
+            url = '/filter/%s/' % session_id
+            elapsed, data = timed(client, url, {})
+            terms = [x[0] for x in data['stem_counts'][:20]] + \
+                [x[0] for x in data['hashtag_counts'][:10]] + \
+                [x[0] for x in data['url_counts'][:10]]
+            for i in range(opts['requests']):
+                k = i % 4
+                requests.append((url, {'filter[]': rnd.sample(terms, k) \
+                    if len(terms) >= k else []}))
+        latencies, results['filter'], responses = \
+            run_requests(client, requests)
+
+        # urls, cold then cached
+        url_counts = [r['url_counts'] for r in responses]
+        requests = []
+        for counts in url_counts:
+            urls = [x[0] for x in counts[:6]]
+            if urls:
+                requests.append(('/urls/', {'urls[]': urls}))
+        if requests:
+            latencies, results['urls_cold'], responses = \
+                run_requests(client, requests)
+            latencies, results['urls_cached'], responses = \
+                run_requests(client, requests)
+
+        results['history'] = history_timings(client, [10, 100, 1000])
+
+        results['spans'] = metrics.snapshot()['spans']
+        results['stages_ms'] = stage_timings(statuses, opts['language'],
+            set([query]))
+        results['peak_rss_kb'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+    finally:
+        _conn.drop_database(_db.name)
+        os.unlink(corpus.name)
+
+
+#
+# main
+#
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+if __name__ == "__main__":
+    try:
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], "hn:s:r:l:o:",
+                ["help", "tweets=", "sessions=", "requests=", "language=",
+                "hashtags=", "urls=", "retweets=", "storage=", "engine=", "output="])
+        except getopt.error as msg:
+            raise Usage(msg)
+
+        # Handle options
+        options = {
+            'tweets': 500,
+            'sessions': 5,
+            'requests': 20,
+            'language': 'en',
+            'hashtags': 0.5,
+            'urls': 0.3,
+            'retweets': 0.2,
+            'storage': 'full'
+        }
+        output = None
+
+        for option, value in opts:
+            if option in ("-h", "--help"):
+                print(__doc__)
+                sys.exit(0)
+            elif option in ("-n", "--tweets"):
+                options['tweets'] = int(value)
+            elif option in ("-s", "--sessions"):
+                options['sessions'] = int(value)
+            elif option in ("-r", "--requests"):
+                options['requests'] = int(value)
+            elif option in ("-l", "--language"):
+                options['language'] = value
+            elif option == "--hashtags":
+                options['hashtags'] = float(value)
+            elif option == "--urls":
+                options['urls'] = float(value)
+            elif option == "--retweets":
+                options['retweets'] = float(value)
+            elif option == "--storage":
+                options['storage'] = value
+            elif option == "--engine":
+                if value not in ('mongo', 'memory'):
+                    raise Usage('invalid engine "%s"' % value)
+                # read by the settings module, which is imported later
+                os.environ['DB_ENGINE__DEFAULT'] = value
+            elif option in ("-o", "--output"):
+                output = value
+            else:
+                raise Usage('unhandled option "%s"' % option)
+
+        # Handle arguments
+        if len(args) > 0:
+            raise Usage("invalid number of arguments")
+
+        # Doit
+        results = run_benchmark(options)
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+
+    except Usage as err:
+        print(err.msg, file=sys.stderr)
+        print("for help use --help", file=sys.stderr)
+        sys.exit(2)
+    except Exception as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    else:
+        sys.exit(0)
@@ -1,84 +1,240 @@
 '''
 Clean up old data.  Be sure to set FLASK_SETTINGS_MODULE environment var.
 
+Unsaved sessions and their tweets also expire through the TTL indexes on
+their 'expires' field (see SESSION_TTL_DAYS); this removes sessions from
+before that, orphan searches, and shared tweets of expired sessions.
+
 Usage:
     python <script> [options]
 
 Options:
     -h, --help
-        Print this help information   
-    
+        Print this help information
+
     -d=<n>, --days=<n>
         Delete unsaved data more than n days old (default = 7)
-        
+
+    -b=<n>, --batch=<n>
+        Sessions or searches to delete per batch (default = 500)
+
+    -s=<seconds>, --sleep=<seconds>
+        Pause between batches, to leave room for live traffic (default = 0.1)
+
+    -n, --dry-run
+        Report what would be deleted and the bytes reclaimed, delete nothing
+
 '''
 import sys
 import getopt
 import os
 import importlib
 import datetime
+import time
+import bson
 import pymongo
 
 # Import settings module
 if __name__ == "__main__":
     if not os.environ.get('FLASK_SETTINGS_MODULE', ''):
-        os.environ['FLASK_SETTINGS_MODULE'] = 'core.settings.loc'
+        os.environ['FLASK_SETTINGS_MODULE'] = 'core.settings'
 
     settings_module = os.environ.get('FLASK_SETTINGS_MODULE')
 
     try:
         importlib.import_module(settings_module)
-    except ImportError, e:
+    except ImportError as e:
         raise ImportError("Could not import settings module '%s': %s" % (settings_module, e))
 
-from twxplorer.connection import _search, _session, _tweets
+from twxplorer.connection import _db, _search, _session, _tweets, \
+    _tweet_store, _facets
+from twxplorer import facets, storage
 
 
-def clean_database(n_days):
-    """Clean database"""
-    print 'settings: %s' % settings_module
-    
-    print 'Clean database: %d days' % n_days    
-    dt = datetime.datetime.utcnow() - datetime.timedelta(days=n_days)
-    dt_str = dt.isoformat()
-    
-    print 'Removing sessions before %s' % dt_str
+def chunks(cursor, size):
+    """Yield lists of up to size documents from cursor"""
+    chunk = []
+    for r in cursor:
+        chunk.append(r)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def avg_obj_size(collection):
+    """Return average document size of collection in bytes"""
+    if collection.name not in _db.list_collection_names():
+        return 0
+    return _db.command('collstats', collection.name).get('avgObjSize', 0)
+
+
+class Report(object):
+    """Documents and estimated bytes removed per collection"""
+    def __init__(self, collections=()):
+        self.counts = {}
+        self.sizes = {}
+        # measured before anything is removed
+        for collection in collections:
+            self.sizes[collection.name] = avg_obj_size(collection)
+
+    def add(self, collection, n):
+        name = collection.name
+        if name not in self.sizes:
+            self.sizes[name] = avg_obj_size(collection)
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def bytes(self):
+        return sum(int(n * self.sizes[k]) for k, n in self.counts.items())
+
+    def __str__(self):
+        lines = ['  %-12s %10d documents  ~%d bytes' % \
+            (k, n, int(n * self.sizes[k])) \
+            for k, n in sorted(self.counts.items())]
+        lines.append('  %-12s %10s            ~%d bytes' % \
+            ('total', '', self.bytes()))
+        return '\n'.join(lines)
+
+
+def measure_sessions(session_ids, report):
+    """Add documents that would be removed with sessions to report"""
+    report.add(_session, len(session_ids))
+    report.add(_tweets,
+        _tweets.count_documents({'session_id': {'$in': session_ids}}) + \
+        _tweets.count_documents({'s': {'$in': session_ids}}))
+    report.add(_facets,
+        _facets.count_documents({'session_id': {'$in': session_ids}}))
+
+    # shared tweets referenced by no other session
+    ids = set(session_ids)
+    n = 0
+    for r in _tweet_store.find({'refs': {'$in': session_ids}}, {'refs': 1}):
+        if set(r['refs']) <= ids:
+            n += 1
+    report.add(_tweet_store, n)
+
+
+def clean_sessions(dt, batch_size, sleep, report, dry_run=False):
+    """Remove unsaved sessions older than dt, with their tweets"""
+    # uses the (saved, dt) index
+    cursor = _session.find(
+        {'$or': [
+            {'saved': {'$ne': 1}, 'dt': {'$lt': dt}},
+            {'saved': {'$ne': 1}, 'dt': {'$lt': dt.isoformat()}}
+        ]},
+        {'_id': 1}
+    ).batch_size(batch_size)
+
+    removed = 0
+    for chunk in chunks(cursor, batch_size):
+        session_ids = [str(r['_id']) for r in chunk]
+        if dry_run:
+            measure_sessions(session_ids, report)
+        else:
+            # counted from the deletes, measuring would only add load
+            n_tweets, n_shared = storage.remove_session(_tweets, session_ids,
+                _tweet_store)
+            report.add(_tweets, n_tweets)
+            report.add(_tweet_store, n_shared)
+            report.add(_facets, facets.remove_index(_facets, session_ids))
+            report.add(_session, _session.delete_many(
+                {'_id': {'$in': [r['_id'] for r in chunk]}}).deleted_count)
+            time.sleep(sleep)
+
+        removed += len(chunk)
+        print('...%d sessions...' % removed)
+    return removed
+
+
+def clean_searches(batch_size, sleep, report, dry_run=False):
+    """Remove searches without sessions"""
+    cursor = _search.find({}, {'_id': 1},
+        sort=[('_id', pymongo.ASCENDING)]).batch_size(batch_size)
+
     removed = 0
-    
-    session_list = list(_session.find(
-        {'saved': {'$ne': 1}, 'dt': {'$lt': dt_str}},
-        {'saved': 1, 'dt': 1}
-    ))
-    for session_r in session_list:
-        # Delete tweets associated with session
-        _tweets.remove({'session_id': str(session_r['_id'])})
-        
-        # Delete session
-        _session.remove({'_id': session_r['_id']})
-        
-        removed += 1        
-        if (removed % 100) == 0:
-            print '...removed %d sessions...' % removed
-    print 'Removed %d sessions' % removed
-    
-    print 'Removing orphan searches'
+    for chunk in chunks(cursor, batch_size):
+        search_ids = [str(r['_id']) for r in chunk]
+        found = set(_session.distinct('search_id',
+            {'search_id': {'$in': search_ids}}))
+        orphans = [bson.ObjectId(x) for x in search_ids if x not in found]
+        if not orphans:
+            continue
+
+        if not dry_run:
+            _search.delete_many({'_id': {'$in': orphans}})
+            time.sleep(sleep)
+        report.add(_search, len(orphans))
+
+        removed += len(orphans)
+        print('...%d orphan searches...' % removed)
+    return removed
+
+
+def clean_tweet_store(batch_size, sleep, report, dry_run=False):
+    """
+    Remove references to sessions that no longer exist (e.g. expired by
+    the TTL index) from shared tweets, and tweets left without references
+    """
+    cursor = _tweet_store.find({}, {'refs': 1}).batch_size(batch_size)
+
     removed = 0
-    
-    search_id_list = _session.distinct('search_id')
-    
-    for search_id in _search.distinct('_id'):
-        if not str(search_id) in search_id_list:
-            _search.remove({'_id': search_id})
-            
-            removed += 1           
-            if (removed % 100) == 0:
-                print '...removed %d sessions...' % removed    
-    print 'Removed %d orphan searches' % removed
-      
+    for chunk in chunks(cursor, batch_size):
+        refs = set()
+        for r in chunk:
+            refs.update(r['refs'])
+        found = set(str(r['_id']) for r in _session.find(
+            {'_id': {'$in': [bson.ObjectId(x) for x in refs]}}, {'_id': 1}))
+        missing = list(refs - found)
+        if not missing:
+            continue
+
+        orphans = [r['_id'] for r in chunk if not set(r['refs']) & found]
+        if not dry_run:
+            _tweet_store.update_many(
+                {'_id': {'$in': [r['_id'] for r in chunk]}},
+                {'$pullAll': {'refs': missing}})
+            _tweet_store.delete_many(
+                {'_id': {'$in': orphans}, 'refs': {'$size': 0}})
+            time.sleep(sleep)
+        report.add(_tweet_store, len(orphans))
+
+        removed += len(orphans)
+        print('...%d unreferenced tweets...' % removed)
+    return removed
+
+
+def clean_database(n_days, batch_size=500, sleep=0.1, dry_run=False):
+    """Clean database"""
+    print('settings: %s' % settings_module)
+
+    print('Clean database: %d days%s' % (n_days, ' (dry run)' if dry_run else ''))
+    dt = datetime.datetime.utcnow() - datetime.timedelta(days=n_days)
+    report = Report([_session, _tweets, _facets, _search, _tweet_store])
+
+    print('Removing sessions before %s' % dt.isoformat())
+    removed = clean_sessions(dt, batch_size, sleep, report, dry_run)
+    print('Removed %d sessions' % removed)
+
+    print('Removing orphan searches')
+    removed = clean_searches(batch_size, sleep, report, dry_run)
+    print('Removed %d orphan searches' % removed)
+
+    print('Removing unreferenced shared tweets')
+    removed = clean_tweet_store(batch_size, sleep, report, dry_run)
+    print('Removed %d unreferenced shared tweets' % removed)
+
+    if dry_run:
+        # not counting searches orphaned by the sessions above
+        print('Would reclaim:')
+    else:
+        print('Reclaimed:')
+    print(report)
+
 #
 # main
 #
-              
+
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -86,36 +242,46 @@ class Usage(Exception):
 if __name__ == "__main__":
     try:
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "hd:", ["help", "days="])
-        except getopt.error, msg:
-             raise Usage(msg)
+            opts, args = getopt.getopt(sys.argv[1:], "hd:b:s:n",
+                ["help", "days=", "batch=", "sleep=", "dry-run"])
+        except getopt.error as msg:
+            raise Usage(msg)
 
-        # Handle options 
+        # Handle options
         opt_days = 7
-        
+        opt_batch = 500
+        opt_sleep = 0.1
+        opt_dry_run = False
+
         for option, value in opts:
             if option in ("-h", "--help"):
-                print __doc__
+                print(__doc__)
                 sys.exit(0)
-            if option in ("-d", "--days"):
+            elif option in ("-d", "--days"):
                 opt_days = int(value)
+            elif option in ("-b", "--batch"):
+                opt_batch = int(value)
+            elif option in ("-s", "--sleep"):
+                opt_sleep = float(value)
+            elif option in ("-n", "--dry-run"):
+                opt_dry_run = True
             else:
                 raise Usage('unhandled option "%s"' % option)
-                            
-        # Handle arguments 
+
+        # Handle arguments
         n_args = len(args)
         if n_args > 0:
-            raise Usage("invalid number of arguments")       
+            raise Usage("invalid number of arguments")
 
         # Doit
-        clean_database(opt_days)
-                            
-    except Usage, err:
-        print >>sys.stderr, err.msg
-        print >>sys.stderr, "for help use --help"
+        clean_database(opt_days, opt_batch, opt_sleep, opt_dry_run)
+
+    except Usage as err:
+        print(err.msg, file=sys.stderr)
+        print("for help use --help", file=sys.stderr)
         sys.exit(2)
-    except Exception, err:
-        print >>sys.stderr, err
+    except Exception as err:
+        print(err, file=sys.stderr)
         sys.exit(1)
     else:
         sys.exit(0)
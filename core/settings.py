@@ -5,6 +5,66 @@ from os import environ as env
 # Maximum number of tweets to retrieve per search session
 TWITTER_SEARCH_LIMIT = 500
 
+# When fewer than TWITTER_QUOTA_LOW requests are left in the rate limit
+# window, fetch at most TWITTER_SEARCH_LIMIT_LOW tweets per search
+TWITTER_QUOTA_LOW = int(env.get('TWITTER_QUOTA_LOW', 20))
+TWITTER_SEARCH_LIMIT_LOW = int(env.get('TWITTER_SEARCH_LIMIT_LOW', 100))
+
+# Replay tweets from this JSONL file instead of searching twitter
+# (for load testing, see twxplorer.sources.FileSource)
+TWEET_SOURCE_FILE = env.get('TWEET_SOURCE_FILE', '')
+
+# Format of stored tweets, 'full', 'compact' or 'shared' across sessions
+# (see twxplorer.storage)
+TWEET_STORAGE = env.get('TWEET_STORAGE', 'full')
+
+# Tweet extraction backend, 'local' (request thread) or 'pool' (processes)
+EXTRACT_BACKEND = env.get('EXTRACT_BACKEND', 'local')
+# Number of pool processes, defaults to the number of cpus
+EXTRACT_POOL_SIZE = int(env.get('EXTRACT_POOL_SIZE', 0)) or None
+
+# Number of threads running analyze jobs (0 = run in the request) and
+# maximum number of queued jobs
+ANALYZE_WORKERS = int(env.get('ANALYZE_WORKERS', 4))
+ANALYZE_QUEUE_SIZE = int(env.get('ANALYZE_QUEUE_SIZE', 16))
+# Jobs without progress for this long (queued, or lost with a restarted
+# worker) are reported as failed
+ANALYZE_STALE_SECONDS = int(env.get('ANALYZE_STALE_SECONDS', 600))
+
+# Re-running a search within this many minutes of its last session only
+# fetches newer tweets and carries over the rest (0 = always fetch all)
+ANALYZE_REFRESH_MINUTES = int(env.get('ANALYZE_REFRESH_MINUTES', 60))
+
+# Unsaved sessions and their tweets are removed by mongo this many days
+# after they were created (0 = keep until clean.py removes them)
+SESSION_TTL_DAYS = int(env.get('SESSION_TTL_DAYS', 7))
+
+# Record timing metrics, exposed at /metrics/ and logged every
+# METRICS_LOG_INTERVAL seconds
+METRICS_ENABLED = env.get('METRICS_ENABLED', '').lower() == 'true'
+METRICS_LOG_INTERVAL = int(env.get('METRICS_LOG_INTERVAL', 60))
+# /metrics/ requires this token (X-Metrics-Token header or ?token=); without
+# one, only requests made directly to the app from localhost are allowed
+METRICS_TOKEN = env.get('METRICS_TOKEN', '')
+
+# Cache for per-user saved results, 'local' (per process) or a redis url
+# shared by all workers, e.g. redis://localhost:6379/0
+HISTORY_CACHE_URL = env.get('HISTORY_CACHE_URL', 'local')
+HISTORY_CACHE_SIZE = int(env.get('HISTORY_CACHE_SIZE', 1000))
+HISTORY_CACHE_TTL = int(env.get('HISTORY_CACHE_TTL', 300))    # seconds
+
+# Url title fetching for urls()
+URL_WORKERS = int(env.get('URL_WORKERS', 8))           # fetch threads
+URL_PER_HOST = int(env.get('URL_PER_HOST', 2))         # fetches per host
+URL_TIMEOUT = int(env.get('URL_TIMEOUT', 5))           # seconds per fetch
+URL_DEADLINE = float(env.get('URL_DEADLINE', 8))       # seconds per request
+URL_NEGATIVE_TTL = int(env.get('URL_NEGATIVE_TTL', 3600))  # retry failures
+URL_MAX_BYTES = int(env.get('URL_MAX_BYTES', 262144))  # read per page
+# Urls per session queued for fetching at analyze time (0 = off), and
+# the most fetches in flight before further prefetches are dropped
+URL_PREFETCH_LIMIT = int(env.get('URL_PREFETCH_LIMIT', 50))
+URL_MAX_PENDING = int(env.get('URL_MAX_PENDING', 200))
+
 SECRET_KEY = env['FLASK_SECRET_KEY']
 STATIC_URL = env['STATIC_URL']
 
@@ -13,7 +73,20 @@ DATABASES = {
         'ENGINE': env['DB_ENGINE__DEFAULT'],
         'NAME': env['DB_NAME__DEFAULT'],
         'HOST': env['DB_HOST__DEFAULT'],
-        'PORT': env['DB_PORT__DEFAULT']
+        'PORT': env['DB_PORT__DEFAULT'],
+        # MongoClient pool and timeouts (ms)
+        'OPTIONS': {
+            'maxPoolSize': int(env.get('DB_MAX_POOL_SIZE__DEFAULT', 50)),
+            'minPoolSize': int(env.get('DB_MIN_POOL_SIZE__DEFAULT', 0)),
+            'waitQueueTimeoutMS': \
+                int(env.get('DB_WAIT_QUEUE_TIMEOUT__DEFAULT', 5000)),
+            'connectTimeoutMS': \
+                int(env.get('DB_CONNECT_TIMEOUT__DEFAULT', 5000)),
+            'socketTimeoutMS': \
+                int(env.get('DB_SOCKET_TIMEOUT__DEFAULT', 30000)),
+            'serverSelectionTimeoutMS': \
+                int(env.get('DB_SERVER_SELECTION_TIMEOUT__DEFAULT', 5000))
+        }
     }
 }
 
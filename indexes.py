@@ -0,0 +1,109 @@
+'''
+Create and audit database indexes.  Be sure to set FLASK_SETTINGS_MODULE
+environment var.  Indexes are listed in twxplorer/indexes.py.
+
+Usage:
+    python <script> [options] <command>
+
+Commands:
+    create
+        Create registered indexes (run at deploy time)
+
+    audit
+        Explain the app's query shapes and flag collection scans, and list
+        indexes that are not registered
+
+Options:
+    -h, --help
+        Print this help information
+
+'''
+import sys
+import getopt
+import os
+import importlib
+
+# Import settings module
+if __name__ == "__main__":
+    if not os.environ.get('FLASK_SETTINGS_MODULE', ''):
+        os.environ['FLASK_SETTINGS_MODULE'] = 'core.settings'
+
+    settings_module = os.environ.get('FLASK_SETTINGS_MODULE')
+
+    try:
+        importlib.import_module(settings_module)
+    except ImportError as e:
+        raise ImportError("Could not import settings module '%s': %s" % (settings_module, e))
+
+from twxplorer.connection import _db
+from twxplorer import indexes
+
+
+def create():
+    """Create registered indexes"""
+    print('Creating %d indexes' % len(indexes.INDEXES))
+    indexes.create_indexes(_db)
+    print('Done')
+
+
+def audit():
+    """Flag query shapes that scan a collection"""
+    n_scans = 0
+    for name, where, scans in indexes.audit(_db):
+        print('%-6s %-12s %s' % ('SCAN' if scans else 'ok', name, where))
+        n_scans += scans
+
+    extra = indexes.extra_indexes(_db)
+    for name, index_name in extra:
+        print('%-6s %-12s %s' % ('EXTRA', name, index_name))
+
+    print('%d collection scans, %d unregistered indexes' % \
+        (n_scans, len(extra)))
+    return n_scans
+
+
+commands = {
+    'create': create,
+    'audit': audit
+}
+
+#
+# main
+#
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+if __name__ == "__main__":
+    try:
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+        except getopt.error as msg:
+            raise Usage(msg)
+
+        # Handle options
+        for option, value in opts:
+            if option in ("-h", "--help"):
+                print(__doc__)
+                sys.exit(0)
+            else:
+                raise Usage('unhandled option "%s"' % option)
+
+        # Handle arguments
+        if len(args) != 1 or args[0] not in commands:
+            raise Usage("specify one command: %s" % ', '.join(commands))
+
+        # Doit
+        if commands[args[0]]():
+            sys.exit(1)
+
+    except Usage as err:
+        print(err.msg, file=sys.stderr)
+        print("for help use --help", file=sys.stderr)
+        sys.exit(2)
+    except Exception as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    else:
+        sys.exit(0)
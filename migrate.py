@@ -0,0 +1,149 @@
+'''
+Migrate stored data.  Be sure to set FLASK_SETTINGS_MODULE environment var.
+
+Usage:
+    python <script> [options] <migration>
+
+Migrations:
+    dt
+        Convert session dt strings to datetimes
+
+    compact
+        Convert tweets of finished sessions to compact storage
+
+Options:
+    -h, --help
+        Print this help information
+
+    -b=<n>, --batch=<n>
+        Documents to update per batch (default = 500)
+
+'''
+import sys
+import getopt
+import os
+import importlib
+import datetime
+
+# Import settings module
+if __name__ == "__main__":
+    if not os.environ.get('FLASK_SETTINGS_MODULE', ''):
+        os.environ['FLASK_SETTINGS_MODULE'] = 'core.settings'
+
+    settings_module = os.environ.get('FLASK_SETTINGS_MODULE')
+
+    try:
+        importlib.import_module(settings_module)
+    except ImportError as e:
+        raise ImportError("Could not import settings module '%s': %s" % (settings_module, e))
+
+from twxplorer.connection import _session, _tweets
+from twxplorer import storage
+
+
+def migrate_dt(batch_size):
+    """Convert session dt strings to datetimes"""
+    print('Converting session dt strings')
+    converted = 0
+
+    while True:
+        # string type = 2
+        session_list = list(_session.find(
+            {'dt': {'$type': 2}}, {'dt': 1}, limit=batch_size))
+        if not session_list:
+            break
+
+        for session_r in session_list:
+            dt = datetime.datetime.strptime(
+                session_r['dt'], '%Y-%m-%dT%H:%M:%S.%f')
+            _session.update_one({'_id': session_r['_id']},
+                {'$set': {'dt': dt}})
+
+        converted += len(session_list)
+        print('...converted %d sessions...' % converted)
+    print('Converted %d sessions' % converted)
+
+
+def migrate_compact(batch_size):
+    """Convert tweets of finished sessions to compact storage"""
+    print('Converting sessions to compact storage')
+    converted = 0
+    tweet_count = 0
+
+    while True:
+        session_list = list(_session.find(
+            {
+                'storage': {'$nin': [storage.COMPACT, storage.SHARED]},
+                'status': {'$nin': ['pending', 'running']}
+            },
+            {'_id': 1}, limit=batch_size))
+        if not session_list:
+            break
+
+        for session_r in session_list:
+            session_id = str(session_r['_id'])
+            tweet_list = list(_tweets.find({'session_id': session_id}))
+
+            # clear any copies left by an interrupted run
+            _tweets.delete_many({'s': session_id})
+            if tweet_list:
+                storage.insert(_tweets, tweet_list, storage.COMPACT)
+            _session.update_one({'_id': session_r['_id']},
+                {'$set': {'storage': storage.COMPACT}})
+            _tweets.delete_many({'session_id': session_id})
+            tweet_count += len(tweet_list)
+
+        converted += len(session_list)
+        print('...converted %d sessions (%d tweets)...' % \
+            (converted, tweet_count))
+    print('Converted %d sessions (%d tweets)' % (converted, tweet_count))
+
+
+migrations = {
+    'dt': migrate_dt,
+    'compact': migrate_compact
+}
+
+#
+# main
+#
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+if __name__ == "__main__":
+    try:
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], "hb:", ["help", "batch="])
+        except getopt.error as msg:
+            raise Usage(msg)
+
+        # Handle options
+        opt_batch = 500
+
+        for option, value in opts:
+            if option in ("-h", "--help"):
+                print(__doc__)
+                sys.exit(0)
+            elif option in ("-b", "--batch"):
+                opt_batch = int(value)
+            else:
+                raise Usage('unhandled option "%s"' % option)
+
+        # Handle arguments
+        if len(args) != 1 or args[0] not in migrations:
+            raise Usage("specify one migration: %s" % ', '.join(migrations))
+
+        # Doit
+        migrations[args[0]](opt_batch)
+
+    except Usage as err:
+        print(err.msg, file=sys.stderr)
+        print("for help use --help", file=sys.stderr)
+        sys.exit(2)
+    except Exception as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    else:
+        sys.exit(0)
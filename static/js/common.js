@@ -49,6 +49,37 @@ function show_warning(message) {
     }
 }
 
+//
+// Poll analyze job for session until it is done, backing off from 1 to 5
+// seconds between polls and giving up after about 10 minutes
+//
+var WAIT_MAX_POLLS = 130;
+
+function wait_for_session(session, on_error, on_success, polls) {
+    polls = polls || 0;
+    if(!session.status || session.status == 'done') {
+        on_success(session);
+        return;
+    }
+    if(polls >= WAIT_MAX_POLLS) {
+        on_error('Search is taking too long, try again later');
+        return;
+    }
+    if(session.progress && session.progress.fetched) {
+        $('#progress_msg').html('Searching Twitter ('
+            + session.progress.fetched + ' tweets)');
+    }
+    setTimeout(function() {
+        do_ajax('/analyze/status/'+session._id+'/', {},
+            on_error,
+            function(data) {
+                wait_for_session(data.session, on_error, on_success,
+                    polls + 1);
+            }
+        );
+    }, Math.min(1000 * Math.pow(1.2, polls), 5000));
+}
+
 function do_ajax(url, data, on_error, on_success) {
     $.ajax({
         url: url,
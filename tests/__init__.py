@@ -0,0 +1,30 @@
+"""
+Tests, run from the repository root with
+
+    python -m unittest
+
+They use the in-memory database engine and local stand-ins for twitter
+and web pages, so no mongod or network access is needed.  nltk stopwords
+must be installed (see README.md).
+"""
+import os
+
+for k, v in [
+    ('FLASK_SETTINGS_MODULE', 'core.settings'),
+    ('FLASK_SETTINGS_FILE', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'core', 'settings.py')),
+    ('FLASK_SECRET_KEY', 'test'),
+    ('STATIC_URL', '/'),
+    ('DB_ENGINE__DEFAULT', 'memory'),
+    ('DB_NAME__DEFAULT', 'twxplorer_test'),
+    ('DB_HOST__DEFAULT', 'localhost'),
+    ('DB_PORT__DEFAULT', '27017'),
+    ('TWITTER_CONSUMER_KEY', ''),
+    ('TWITTER_CONSUMER_SECRET', ''),
+    ('BITLY_USERNAME', ''),
+    ('BITLY_APIKEY', ''),
+    ('BITLY_DOMAIN', ''),
+    ('URL_PREFETCH_LIMIT', '0'),
+    ('METRICS_ENABLED', 'false')]:
+    os.environ.setdefault(k, v)
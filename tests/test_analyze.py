@@ -0,0 +1,206 @@
+"""
+analyze jobs end to end: tweets replayed from a JSONL file through a
+FileSource that can be paused mid-fetch, on the in-memory database
+"""
+import datetime
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import bson
+
+import api
+from twxplorer import facets, jobs, sources
+from twxplorer.connection import _conn, _db, _session, _tweets, _facets
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def make_statuses(n):
+    """Return n status dicts with the english sample tweet texts"""
+    with open(os.path.join(DATA_DIR, 'sample_tweets.jsonl')) as f:
+        texts = [json.loads(line)['text'] for line in f \
+            if json.loads(line)['lang'] == 'en']
+    statuses = []
+    for i in range(n):
+        text = texts[i % len(texts)]
+        statuses.append({
+            'id': 1000 + n - i,
+            'id_str': str(1000 + n - i),
+            'text': text,
+            'lang': 'en',
+            'created_at': 'Wed Jan 01 12:00:%02d +0000 2014' % (i % 60),
+            'user': {'id_str': str(i), 'name': 'User %d' % i,
+                'screen_name': 'user%d' % i},
+            'entities': {
+                'hashtags': [{'text': 'storm'}] if '#storm' in text else [],
+                'urls': [{'url': 'http://t.co/%d' % i,
+                    'expanded_url': 'http://example.com/%d' % (i % 3)}],
+                'user_mentions': []
+            }
+        })
+    return statuses
+
+
+class PausedSource(sources.FileSource):
+    """FileSource that waits for resume after pause_after tweets"""
+    def __init__(self, path, since_id=None, pause_after=None):
+        super(PausedSource, self).__init__(path, since_id)
+        self.pause_after = pause_after
+        self.paused = threading.Event()
+        self.resume = threading.Event()
+
+    def items(self, limit=None):
+        for i, status in enumerate(super(PausedSource, self).items(limit)):
+            if i == self.pause_after:
+                self.paused.set()
+                self.resume.wait(10)
+            yield status
+
+
+class AnalyzeJobTest(unittest.TestCase):
+    n_tweets = 250
+
+    def setUp(self):
+        _conn.drop_database(_db.name)
+        api.history_cache.delete('test')
+
+        f = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        self.path = f.name
+        self.statuses = make_statuses(self.n_tweets)
+        sources.write_statuses(self.path, self.statuses)
+
+        self.source = None
+        self.pause_after = 150
+
+        def make_source(path, since_id=None):
+            self.source = PausedSource(path, since_id, self.pause_after)
+            return self.source
+
+        for patcher in [
+            mock.patch.object(api.settings, 'TWEET_SOURCE_FILE', self.path),
+            mock.patch.object(api.settings, 'TWEET_STORAGE', 'full'),
+            mock.patch.object(api.settings, 'ANALYZE_REFRESH_MINUTES', 0),
+            mock.patch.object(api.sources, 'FileSource', make_source),
+            mock.patch.object(api, 'analyze_jobs', jobs.JobQueue(1, 4))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = api.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['request_token'] = 'test'
+            sess['request_token_secret'] = 'test'
+            sess['access_token'] = 'test'
+            sess['access_token_secret'] = 'test'
+            sess['username'] = 'test'
+
+    def get_json(self, url, params=None):
+        resp = self.client.get(url, query_string=params or {})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.get_data(as_text=True))
+        self.assertNotIn('error', data)
+        return data
+
+    def wait_done(self, session_id):
+        for i in range(200):
+            data = self.get_json('/analyze/status/%s/' % session_id)
+            if data['session']['status'] == 'done':
+                return data['session']
+            threading.Event().wait(0.05)
+        self.fail('analyze job did not finish')
+
+    def test_progress(self):
+        data = self.get_json('/analyze/', {'query': 'test'})
+        session_id = data['session']['_id']
+        self.assertEqual(data['session']['status'], 'pending')
+
+        # paused mid-fetch, after the first batch was reported
+        self.assertTrue(self.source.paused.wait(10))
+        data = self.get_json('/analyze/status/%s/' % session_id)
+        self.assertEqual(data['session']['status'], 'running')
+        self.assertEqual(data['session']['progress']['fetched'], 100)
+        self.assertEqual(data['session']['progress']['stored'], 0)
+
+        # saved while the job runs
+        self.get_json('/history/update/%s/' % session_id, {'saved': 1})
+        self.source.resume.set()
+
+        session_r = self.wait_done(session_id)
+        self.assertEqual(session_r['progress'], {
+            'fetched': self.n_tweets,
+            'processed': self.n_tweets,
+            'stored': self.n_tweets
+        })
+        self.assertEqual(session_r['tweet_count'], self.n_tweets)
+        self.assertEqual(session_r['max_id'], str(1000 + self.n_tweets))
+
+        session_r = _session.find_one({'_id': bson.ObjectId(session_id)})
+        self.assertEqual(session_r['saved'], 1)
+        self.assertNotIn('expires', session_r)
+        self.assertTrue(session_r['stem_map'])
+        self.assertNotIn('facets', session_r)
+        index = facets.load_index(_facets, session_id,
+            session_r['facet_docs'])
+        self.assertEqual(len(index['urls']), 3)
+        self.assertEqual(_facets.count_documents(
+            {'session_id': session_id, 'expires': {'$exists': True}}), 0)
+
+        self.assertEqual(_tweets.count_documents(
+            {'session_id': session_id}), self.n_tweets)
+        self.assertEqual(_tweets.count_documents(
+            {'session_id': session_id, 'expires': {'$exists': True}}), 0)
+
+        data = self.get_json('/filter/%s/' % session_id)
+        self.assertEqual(len(data['tweets']), self.n_tweets)
+
+    def test_refresh_saved(self):
+        # the older tweets, analyzed unsaved
+        sources.write_statuses(self.path, self.statuses[50:])
+        self.pause_after = None
+        data = self.get_json('/analyze/', {'query': 'test'})
+        previous_id = self.wait_done(data['session']['_id'])['_id']
+        self.assertEqual(_tweets.count_documents({'session_id': previous_id,
+            'expires': {'$exists': True}}), self.n_tweets - 50)
+
+        # refreshed with the 50 newer ones, and saved while the job runs
+        sources.write_statuses(self.path, self.statuses)
+        self.pause_after = 25
+        with mock.patch.object(api.settings, 'ANALYZE_REFRESH_MINUTES', 10):
+            data = self.get_json('/analyze/', {'query': 'test'})
+        session_id = data['session']['_id']
+        self.assertEqual(data['session']['refreshed_from'], previous_id)
+        self.assertTrue(self.source.paused.wait(10))
+        self.get_json('/history/update/%s/' % session_id, {'saved': 1})
+        self.source.resume.set()
+
+        session_r = self.wait_done(session_id)
+        self.assertEqual(session_r['progress']['reused'], self.n_tweets - 50)
+        self.assertEqual(_tweets.count_documents(
+            {'session_id': session_id}), self.n_tweets)
+        self.assertEqual(_tweets.count_documents(
+            {'session_id': session_id, 'expires': {'$exists': True}}), 0)
+
+    def test_stale(self):
+        data = self.get_json('/analyze/', {'query': 'test'})
+        session_id = data['session']['_id']
+        self.assertTrue(self.source.paused.wait(10))
+
+        # as if the worker running the job had been restarted
+        _session.update_one({'_id': bson.ObjectId(session_id)},
+            {'$set': {'heartbeat': datetime.datetime.now() - \
+                datetime.timedelta(hours=1)}})
+        resp = self.client.get('/analyze/status/%s/' % session_id)
+        data = json.loads(resp.get_data(as_text=True))
+        self.assertIn('interrupted', data['error'])
+
+        self.source.resume.set()
+        api.analyze_jobs._queue.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Golden output of extract.tokenize and NgramExtractor for the sample tweets
+in data/sample_tweets.jsonl.  sample_tweets.golden.json was recorded with
+the implementation before the single-pass normalize (per-character control
+character filter, mention split and punctuation regex), so any change to
+tokens, stems or stem_map shows up here.
+"""
+import json
+import os
+import unittest
+
+from twxplorer import extract
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def load_data():
+    with open(os.path.join(DATA_DIR, 'sample_tweets.jsonl')) as f:
+        tweets = [json.loads(line) for line in f]
+    with open(os.path.join(DATA_DIR, 'sample_tweets.golden.json')) as f:
+        golden = json.load(f)
+    return tweets, golden
+
+
+class GoldenTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tweets, cls.golden = load_data()
+
+    def test_tokens(self):
+        self.assertEqual(len(self.tweets), len(self.golden['tokens']))
+        for tweet, tokens in zip(self.tweets, self.golden['tokens']):
+            self.assertEqual(extract.tokenize(tweet['text']), tokens,
+                tweet['text'])
+
+    def test_stems(self):
+        by_language = {}
+        for tweet in self.tweets:
+            by_language.setdefault(tweet['lang'], []).append(
+                extract.tokenize(tweet['text']))
+        self.assertEqual(sorted(by_language),
+            sorted(self.golden['languages']))
+
+        for language, token_lists in by_language.items():
+            extractor = extract.NgramExtractor(
+                extract.get_stemmer(language), extract.get_stoplist(language))
+            for tokens in token_lists:
+                extractor.add(tokens)
+            tweet_stems, stem_map = extractor.finish()
+
+            expected = self.golden['languages'][language]
+            self.assertEqual([sorted(x) for x in tweet_stems],
+                expected['stems'], language)
+            self.assertEqual(stem_map, expected['stem_map'], language)
+
+
+if __name__ == '__main__':
+    unittest.main()
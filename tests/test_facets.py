@@ -0,0 +1,95 @@
+"""
+Facet index storage, and FacetEngine.select against counts over the tweets
+"""
+import random
+import unittest
+from collections import Counter
+from unittest import mock
+
+from twxplorer import facets, memory
+
+
+def make_tweets(n, seed=0):
+    rnd = random.Random(seed)
+    stems = ['s%d' % i for i in range(200)]
+    return [{
+        'stems': list(dict.fromkeys(
+            rnd.sample(stems[:20], 3) + rnd.sample(stems, 3))),
+        'hashtags': ['#h%d' % rnd.randint(0, 9)] if rnd.random() < 0.5 else [],
+        'urls': ['http://example.com/%d' % rnd.randint(0, 4)]
+    } for i in range(n)]
+
+
+class IndexStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = memory.MemoryClient()['test']['facets']
+        self.index = facets.build_index(make_tweets(500))
+
+    def test_round_trip(self):
+        n = facets.save_index(self.collection, 's1', self.index)
+        self.assertEqual(n, 3)
+        self.assertEqual(facets.load_index(self.collection, 's1', n),
+            self.index)
+
+    def test_chunks(self):
+        with mock.patch.object(facets, 'MAX_DOC_BYTES', 2000):
+            n = facets.save_index(self.collection, 's1', self.index)
+        self.assertGreater(n, 3)
+        self.assertEqual(facets.load_index(self.collection, 's1', n),
+            self.index)
+
+    def test_incomplete(self):
+        n = facets.save_index(self.collection, 's1', self.index)
+        self.collection.delete_one({'session_id': 's1', 'field': 'urls'})
+        self.assertIsNone(facets.load_index(self.collection, 's1', n))
+
+    def test_expires_and_remove(self):
+        facets.save_index(self.collection, 's1', self.index, expires=1)
+        facets.save_index(self.collection, 's2', self.index)
+        facets.set_expires(self.collection, 's1', None)
+        self.assertEqual(self.collection.count_documents(
+            {'expires': {'$exists': True}}), 0)
+        facets.remove_index(self.collection, ['s1'])
+        self.assertEqual(self.collection.distinct('session_id'), ['s2'])
+
+
+
+class SelectTest(unittest.TestCase):
+    def setUp(self):
+        self.tweets = make_tweets(500)
+        self.engine = facets.FacetEngine(facets.build_index(self.tweets))
+
+    def expected(self, filters):
+        matched = [i for i, tweet in enumerate(self.tweets) \
+            if all(set(terms) <= set(tweet[field]) \
+                for field, terms in filters.items())]
+        counts = {}
+        for field in facets.FIELDS:
+            # ties in the order terms first appear in the session
+            first = {}
+            for tweet in self.tweets:
+                for term in tweet[field]:
+                    first.setdefault(term, len(first))
+            counter = Counter()
+            for i in matched:
+                counter.update(self.tweets[i][field])
+            counts[field] = sorted(
+                [x for x in counter.items() \
+                    if x[0] not in filters.get(field, [])],
+                key=lambda x: (-x[1], first[x[0]]))
+        return (matched if filters else None, counts)
+
+    def test_select(self):
+        for filters in [
+            {},
+            {'stems': ['s1']},
+            {'stems': ['s1', 's2']},
+            {'hashtags': ['#h3']},
+            {'stems': ['s4'], 'urls': ['http://example.com/2']},
+            {'stems': ['missing']}]:
+            self.assertEqual(self.engine.select(filters),
+                self.expected(filters), filters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Url title resolver against a local http server standing in for the web
+"""
+import http.server
+import threading
+import time
+import unittest
+
+from twxplorer import memory, resolver
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /title/<name>       page titled <name>
+    /redirect/<name>    302 to /title/<name>
+    /flaky/<name>       500 on the first request, then titled <name>
+    /slow/<name>        titled <name> after a second
+    /big/<n>            title after n bytes of padding
+    """
+    hits = {}
+
+    def do_GET(self):
+        kind, name = self.path.strip('/').split('/', 1)
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if kind == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', '/title/%s' % name)
+            self.end_headers()
+            return
+        if kind == 'flaky' and self.hits[self.path] == 1:
+            self.send_error(500)
+            return
+        if kind == 'slow':
+            time.sleep(1)
+
+        padding = ' ' * int(name) if kind == 'big' else ''
+        body = ('<html><head>%s<title>%s</title></head></html>' % \
+            (padding, name)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ResolverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), PageHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        PageHandler.hits.clear()
+        self.collection = memory.MemoryClient()['test']['url']
+        self.resolver = resolver.Resolver(self.collection, workers=4,
+            per_host=4, timeout=5, negative_ttl=0.5)
+
+    def test_redirect_alias(self):
+        url = self.base + '/redirect/home'
+        self.assertEqual(self.resolver.resolve([url]),
+            [{'url': url, 'title': 'home'}])
+
+        r = self.collection.find_one({'url': self.base + '/title/home'})
+        self.assertEqual(r['aka'], [url])
+
+        # found by its alias, without another fetch
+        self.assertEqual(self.resolver.resolve([url]),
+            [{'url': url, 'title': 'home'}])
+        self.assertEqual(PageHandler.hits['/redirect/home'], 1)
+
+    def test_negative_entry(self):
+        url = self.base + '/flaky/later'
+        self.assertEqual(self.resolver.resolve([url]),
+            [{'url': url, 'title': ''}])
+        r = self.collection.find_one({'url': url})
+        self.assertIn('error', r)
+
+        # not retried before negative_ttl
+        self.resolver.resolve([url])
+        self.assertEqual(PageHandler.hits['/flaky/later'], 1)
+
+        time.sleep(0.6)
+        self.assertEqual(self.resolver.resolve([url]),
+            [{'url': url, 'title': 'later'}])
+        self.assertEqual(PageHandler.hits['/flaky/later'], 2)
+        self.assertNotIn('error', self.collection.find_one({'url': url}))
+
+    def test_deadline(self):
+        fast = self.base + '/title/fast'
+        slow = self.base + '/slow/slow'
+        self.assertEqual(self.resolver.resolve([slow, fast], deadline=0.5), [
+            {'url': slow, 'title': '', 'pending': True},
+            {'url': fast, 'title': 'fast'}
+        ])
+
+        # finished in the background
+        self.resolver.submit(slow).result(5)
+        self.assertEqual(self.resolver.resolve([slow], deadline=0.5),
+            [{'url': slow, 'title': 'slow'}])
+
+    def test_max_bytes(self):
+        url = self.base + '/big/%d'
+        self.assertEqual(resolver.fetch_title(url % 1000, max_bytes=16384),
+            (url % 1000, '1000'))
+        self.assertEqual(resolver.fetch_title(url % 50000, max_bytes=16384),
+            (url % 50000, ''))
+
+    def test_per_host_queue(self):
+        release = threading.Event()
+
+        def fetch(url, timeout, max_bytes):
+            if url.startswith('http://busy/'):
+                release.wait(5)
+            return (url, url.rsplit('/', 1)[1])
+
+        r = resolver.Resolver(self.collection, workers=2, per_host=1,
+            fetch=fetch)
+        busy = [r.submit('http://busy/%d' % i) for i in range(5)]
+
+        # the busy host holds one worker, the other serves other hosts
+        self.assertEqual(r.submit('http://other/a').result(2)['title'], 'a')
+        self.assertEqual(len(r._hosts['busy'][1]), 4)
+
+        release.set()
+        for future in busy:
+            future.result(5)
+        r._get_executor().shutdown()    # hosts are released after results
+        self.assertEqual(r._hosts, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
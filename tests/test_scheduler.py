@@ -0,0 +1,103 @@
+"""
+FetchScheduler against a fake source that simulates rate limit headers
+"""
+import time
+import unittest
+
+import tweepy
+
+from twxplorer import scheduler
+
+
+class QuotaSource(object):
+    """
+    Pages of page_size tweets from a shared quota of requests, which
+    answers 429 once used up until reset
+    """
+    quota_key = ('/search/tweets', 'token')
+
+    def __init__(self, quota, n_tweets, page_size=10):
+        self.quota = quota          # see make_quota
+        self.n_tweets = n_tweets
+        self.page_size = page_size
+        self.calls = 0
+
+    def read_quota(self):
+        return (self.quota['remaining'], self.quota['reset'])
+
+    def items(self, limit=None):
+        self.calls += 1
+        n = self.n_tweets if limit is None else min(limit, self.n_tweets)
+        for i in range(n):
+            if i % self.page_size == 0:
+                if self.quota['reset'] <= time.time():
+                    self.quota['remaining'] = self.quota['limit']
+                    self.quota['reset'] = time.time() + self.quota['window']
+                if self.quota['remaining'] <= 0:
+                    raise tweepy.RateLimitError('Rate limit exceeded')
+                self.quota['remaining'] -= 1
+            yield i
+
+
+def make_quota(remaining, window=60):
+    """Return quota of remaining requests per window seconds"""
+    return {'remaining': remaining, 'limit': remaining, 'window': window,
+        'reset': time.time() + window}
+
+
+class FetchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = scheduler.FetchScheduler(page_size=10, low_quota=0)
+
+    def fetch(self, key, source, limit=None):
+        return list(self.scheduler.source(key, source).items(limit))
+
+    def test_backoff(self):
+        quota = make_quota(3)
+        source = QuotaSource(quota, 100)
+
+        # quota unknown at first, the 429 keeps the tweets fetched so far
+        self.assertEqual(len(self.fetch('a', source)), 30)
+        self.assertEqual(self.scheduler.get_quota(source.quota_key),
+            (0, quota['reset']))
+
+        # later fetches fail fast, without asking the source
+        other = QuotaSource(quota, 100)
+        with self.assertRaises(scheduler.RateLimited):
+            self.fetch('b', other)
+        self.assertEqual(other.calls, 0)
+
+    def test_low_quota(self):
+        self.scheduler.low_quota = 5
+        self.scheduler.low_limit = 20
+        quota = make_quota(4)
+        self.scheduler._quota[QuotaSource.quota_key] = (4, quota['reset'])
+
+        # degraded to low_limit, within the pages left
+        self.assertEqual(len(self.fetch('a', QuotaSource(quota, 100))), 20)
+        self.assertEqual(quota['remaining'], 2)
+
+    def test_resume_after_reset(self):
+        quota = make_quota(1, window=0.5)
+        self.assertEqual(len(self.fetch('a', QuotaSource(quota, 100))), 10)
+        with self.assertRaises(scheduler.RateLimited):
+            self.fetch('b', QuotaSource(quota, 100))
+
+        time.sleep(0.6)
+        self.assertIsNone(self.scheduler.get_quota(QuotaSource.quota_key))
+        self.assertEqual(len(self.fetch('b', QuotaSource(quota, 100))), 10)
+
+    def test_fair_share(self):
+        quota = make_quota(6)
+        self.scheduler._quota[QuotaSource.quota_key] = (6, quota['reset'])
+
+        # queued at once, each gets a share of what is left when it runs
+        queued = [self.scheduler.source(key, QuotaSource(quota, 100)) \
+            for key in 'abc']
+        self.assertEqual([len(list(s.items())) for s in queued],
+            [20, 20, 20])
+        self.assertEqual(quota['remaining'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
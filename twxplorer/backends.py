@@ -0,0 +1,96 @@
+"""
+Extraction backends for analyze()
+
+local   tokenize, stem and stoplist tweets in the request thread
+pool    send batches of tweet texts to a warm process pool
+"""
+import concurrent.futures
+import multiprocessing
+import threading
+
+from twxplorer import extract, metrics
+
+# number of tweets sent to the backend at a time (one page of search results)
+BATCH_SIZE = 100
+
+
+def extract_batch(texts, language, stopwords=None, memo=None):
+    """
+    Tokenize, stem and stoplist texts
+    @stopwords  extra (session) stopwords on top of the language stoplist
+    @memo       (tokens, stems or None) or None per text, from an earlier
+                extraction of the same tweet (see twxplorer.storage)
+    @return     [(tokens, clauses)] per text, see extract.prepare
+    """
+    stemmer = extract.get_stemmer(language)
+    stoplist = extract.get_stoplist(language)
+    if stopwords:
+        stoplist = stoplist.extend(stopwords)
+
+    memo = memo or [None] * len(texts)
+
+    with metrics.span('extract.tokenize'):
+        tokens = [m[0] if m else extract.tokenize(text) \
+            for text, m in zip(texts, memo)]
+    with metrics.span('extract.stem'):
+        clauses = [extract.prepare(x, stemmer, stoplist, m and m[1]) \
+            for x, m in zip(tokens, memo)]
+    return list(zip(tokens, clauses))
+
+
+class LocalBackend(object):
+    """Run extraction in the calling thread"""
+    def submit(self, texts, language, stopwords=None, memo=None):
+        """Extract texts, return a completed future"""
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(
+                extract_batch(texts, language, stopwords, memo))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class PoolBackend(object):
+    """
+    Run extraction in a process pool.  The pool is started on first use,
+    i.e. after gunicorn has forked its workers, from a forkserver that has
+    already imported twxplorer.extract, so every pool process starts with
+    the stopword sets and stemmers loaded and shares their memory.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                try:
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['twxplorer.extract'])
+                except ValueError:
+                    context = multiprocessing.get_context()
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=context)
+            return self._executor
+
+    def submit(self, texts, language, stopwords=None, memo=None):
+        """Queue texts for extraction, return a future"""
+        return self._get_executor().submit(extract_batch,
+            list(texts), language, list(stopwords or []), memo)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def get_backend(name, processes=None):
+    """Return extraction backend by name ('local' or 'pool')"""
+    if name == 'local':
+        return LocalBackend()
+    if name == 'pool':
+        return PoolBackend(processes)
+    raise Exception('Unknown extraction backend "%s"' % name)
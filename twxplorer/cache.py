@@ -0,0 +1,73 @@
+"""
+Caches for per-user data
+
+local           in-process, bounded size and TTL (default)
+redis://...     shared by all workers, needs the redis package
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+
+class LocalCache(object):
+    """In-process LRU cache with a TTL"""
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value or None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisCache(object):
+    """Cache shared through redis, values stored as JSON"""
+    def __init__(self, url, ttl=300, prefix='twxplorer:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """Return cached value or None"""
+        value = self.client.get(self.prefix+key)
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value):
+        self.client.setex(self.prefix+key, self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(self.prefix+key)
+
+
+def get_cache(url, maxsize=1000, ttl=300):
+    """Return cache for url ('local' or 'redis://...')"""
+    if url == 'local':
+        return LocalCache(maxsize, ttl)
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisCache(url, ttl)
+    raise Exception('Unknown cache "%s"' % url)
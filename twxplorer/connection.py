@@ -1,40 +1,103 @@
 import sys
 import os
+import threading
+import time
 import pymongo
+from pymongo import monitoring
+
+from twxplorer import metrics
 
 
 # Get settings module
 settings = sys.modules[os.environ['FLASK_SETTINGS_MODULE']]
 
-# Connect to mongo database
-_conn = pymongo.Connection(
-    settings.DATABASES['default']['HOST'],
-    int(settings.DATABASES['default']['PORT'])
-)
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters for /metrics/, and checkout wait times as the
+    'mongo.pool.checkout' span
+    """
+    def __init__(self):
+        self.stats = {
+            'open': 0,
+            'checked_out': 0,
+            'created': 0,
+            'closed': 0,
+            'check_out_failed': 0
+        }
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _incr(self, k, n=1):
+        with self._lock:
+            self.stats[k] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr('created')
+        self._incr('open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr('closed')
+        self._incr('open', -1)
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._incr('check_out_failed')
+
+    def connection_checked_out(self, event):
+        self._incr('checked_out')
+        start = getattr(self._local, 'start', None)
+        if start is not None and metrics.enabled:
+            metrics.record('mongo.pool.checkout',
+                (time.perf_counter() - start) * 1000)
+
+    def connection_checked_in(self, event):
+        self._incr('checked_out', -1)
+
+
+pool_metrics = PoolMetrics()
+
+if settings.DATABASES['default']['ENGINE'] == 'memory':
+    # Single process, no mongod (benchmarks and tests), see memory.py
+    from twxplorer import memory
+    _conn = memory.MemoryClient()
+else:
+    # Client connects on first use, i.e. in each gunicorn worker after fork
+    _conn = pymongo.MongoClient(
+        settings.DATABASES['default']['HOST'],
+        int(settings.DATABASES['default']['PORT']),
+        connect=False,
+        event_listeners=[pool_metrics],
+        **settings.DATABASES['default'].get('OPTIONS', {})
+    )
 _db = _conn[settings.DATABASES['default']['NAME']]
 
 # Mongo collections
 _search = _db['search']
 _session = _db['session']
 _tweets = _db['tweets']
+_tweet_store = _db['tweet_store']
+_facets = _db['facets']
 _url = _db['url']
 _list = _db['list']
 
 
-# Ensure indicies
-_search.ensure_index('username')
-_search.ensure_index([
-    ('username', pymongo.ASCENDING),
-    ('query', pymongo.ASCENDING)])
-
-_session.ensure_index('search_id')
-
-_tweets.ensure_index([
-    ('session_id', pymongo.ASCENDING),
-    ('created_at', pymongo.DESCENDING)])
-
-_url.ensure_index('url')
-_url.ensure_index('aka')
-
-_list.ensure_index('username')
-
+# Indexes are created at deploy time, see twxplorer/indexes.py
@@ -3,11 +3,13 @@ import sys
 import os
 import re
 import string
-from html.parser import HTMLParser
+import functools
+import html
 import nltk
 from nltk.corpus import stopwords
 from nltk import SnowballStemmer
 import unicodedata
+from collections import defaultdict, Counter
 
 # available languages (languages, ISO 639-1 code)
 # ref: http://en.wikipedia.org/wiki/List_of_ISO_639-1_codes
@@ -29,7 +31,65 @@ stopword_languages = [
 ]
 
 stopword_sets = {}  # language code -> set()
-stemmers = {}       # language code -> stemmer
+stemmers = {}       # language code -> CachingStemmer
+stoplists = {}      # language code -> Stoplist
+
+# maximum number of cached stems per language
+STEM_CACHE_SIZE = 100000
+
+# maximum number of cached stoplist verdicts per language
+STOPLIST_CACHE_SIZE = 100000
+
+
+class CachingStemmer(object):
+    """
+    Wraps a stemmer with a bounded LRU cache of stems.  Instances live in
+    the module-level stemmers dict, so the cache is shared by all requests
+    in the process.
+    """
+    def __init__(self, stemmer, maxsize=STEM_CACHE_SIZE):
+        self.stemmer = stemmer
+        self.stem = functools.lru_cache(maxsize=maxsize)(stemmer.stem)
+
+    @property
+    def hits(self):
+        return self.stem.cache_info().hits
+
+    @property
+    def misses(self):
+        return self.stem.cache_info().misses
+
+    def cache_clear(self):
+        self.stem.cache_clear()
+
+
+class Stoplist(object):
+    """
+    Stoplist for a language with a cached verdict per token string.
+    extend() layers session stopwords on top without copying the
+    language set or its cache.
+    """
+    def __init__(self, stopwords, base=None, maxsize=STOPLIST_CACHE_SIZE):
+        self.stopwords = stopwords
+        self.base = base
+        if base is None:
+            self._verdict = functools.lru_cache(maxsize=maxsize)(
+                lambda token: bool(stoplist(token, self.stopwords)))
+
+    def is_stopped(self, token):
+        """Return True if token should be stoplisted."""
+        if self.base is None:
+            return self._verdict(token)
+        return token in self.stopwords or self.base.is_stopped(token)
+
+    def classify(self, tokens):
+        """Return list of stoplist verdicts for tokens"""
+        return [self.is_stopped(t) for t in tokens]
+
+    def extend(self, words):
+        """Return Stoplist that also stops words"""
+        return Stoplist(set(words), base=self)
+
 
 bonus_stopwords = {
     'fr': ['les']
@@ -42,7 +102,8 @@ for (lang_name, lang_code) in stopword_languages:
         stopword_sets[lang_code].update(bonus_stopwords[lang_code])
     except KeyError:
         pass
-    stemmers[lang_code] = SnowballStemmer(lang_name)
+    stemmers[lang_code] = CachingStemmer(SnowballStemmer(lang_name))
+    stoplists[lang_code] = Stoplist(stopword_sets[lang_code])
 
 
 # single letters, all punctuation/numbers, or usermention
@@ -54,18 +115,26 @@ _re_url = re.compile(r'http[^ ]+', re.I)
 # match clause delimiters
 _re_clause = re.compile(u'[.?!:;,"\r\n“”—…]|\s+[\'‘]|[\'’]\s+|#\w{1,15}', re.U)
 
-# user mentions (not hashtags, since now treating as clause delimiter)
-#_re_entity = re.compile(r'(@\w{1,15}|#\w{1,15})')
-_re_entity = re.compile(r'(@\w{1,15})')
-
-# punctuation except '@'
-_re_punctuation = re.compile(u'[%s’]+' % string.punctuation.replace('@', ''), re.U)
+# user mentions (not hashtags, since now treating as clause delimiter) to
+# keep as-is, or runs of punctuation except '@' to replace with a space
+_re_normalize = re.compile(r'(@\w{1,15})|[%s’]+' % \
+    string.punctuation.replace('@', ''), re.U)
 
 # extra space
 _re_extraspace = re.compile(r'( )+')
 
-# htmlparser
-_htmlparser = HTMLParser()
+
+class _ControlCharTable(dict):
+    """
+    str.translate table that deletes unicode control/format characters
+    (category C*), filled in lazily as new characters are seen
+    """
+    def __missing__(self, c):
+        value = None if unicodedata.category(chr(c))[0] == 'C' else c
+        self[c] = value
+        return value
+
+_control_chars = _ControlCharTable()
 
 def get_stopwords(language='en'):
     """Return the stopwords for language"""
@@ -73,29 +142,31 @@ def get_stopwords(language='en'):
         raise Exception('Unknown language "%s"' % language)
     return stopword_sets[language]
    
+def get_stoplist(language='en'):
+    """Return the Stoplist for language"""
+    if not language in stoplists:
+        raise Exception('Unknown language "%s"' % language)
+    return stoplists[language]
+
 def get_stemmer(language='en'):
     """Return the stemmer for language"""
     if not language in stemmers:
         raise Exception('Unknown language "%s"' % language)
     return stemmers[language]
     
+def _normalize_match(m):
+    """Keep user mentions, replace punctuation with a space"""
+    return m.group(1) or ' '
+
+def _normalize(s):
+    """Return normalized version of string, without collapsing spaces."""
+    # assumes we're not dealing with any CJKV languages
+    s = s.lower().translate(_control_chars)
+    return _re_normalize.sub(_normalize_match, s)
+
 def normalize(s):
     """Return normalized version of string."""
-    # s = s.encode('ascii', 'replace').replace('?', '').lower() # doesn't treat non-English very well.
-    s = filter(lambda x: unicodedata.category(x)[0] != 'C',s.lower()) # assumes we're not dealing with any CJKV languages
-    s = ''.join(s)
-    norm = ''
-    for item in _re_entity.split(s):
-        if _re_entity.match(item):
-            if item.startswith('@'):
-                norm += item
-            # no hashtags anymore
-            #else:
-            #    norm += item[1:]
-        else:
-            norm += _re_punctuation.sub(' ', item)
-
-    return _re_extraspace.sub(' ', norm).strip()
+    return _re_extraspace.sub(' ', _normalize(s)).strip()
 
 def tokenize(s):
     """
@@ -105,20 +176,17 @@ def tokenize(s):
     tokens = []
     
     s = _re_url.sub(' . ', s)
-    s = _htmlparser.unescape(s)
-    
+    s = html.unescape(s)
+
     for clause in _re_clause.split(s):
-        items = normalize(clause).strip().split()
+        items = _normalize(clause).split()
         if items:
-            tokens.append(items)    
+            tokens.append(items)
     return tokens
 
 def is_all_numbers_and_punctuation_in_unicode(token):
     # the _re_stoplist regex doesn't take unicode into account
-    categories = set()
-    for x in token:
-        categories.add(unicodedata.category(x)[0])
-    return (not "L" in categories)
+    return not any(unicodedata.category(x)[0] == 'L' for x in token)
     
 def stoplist(token, stopwords):
     """Return True if token should be stoplisted."""
@@ -137,8 +205,138 @@ def stems_from_grams(grams, stemmer):
         )
     return stems
 
-            
-    
+def prepare(tokens, stemmer, stoplist, stems=None):
+    """
+    Stem and stoplist tokens (list of lists, from tokenize)
+    @stems      stems per clause from an earlier prepare() with the same
+                stemmer, to skip stemming
+    @return     [(tokens, stems, stoplist verdicts)] per clause
+    """
+    if stems is None:
+        stems = [[w if w.startswith('@') else stemmer.stem(w) for w in words]
+            for words in tokens]
+    return [(words, clause_stems, stoplist.classify(words)) \
+        for words, clause_stems in zip(tokens, stems)]
 
-    
-    
+
+class NgramExtractor(object):
+    """
+    Streaming n-gram extraction for a search session.
+
+    Tweets are added one at a time as they arrive.  Each token is stemmed
+    and stoplisted once, and trigram candidates are counted on the way in.
+    finish() resolves the bigrams and unigrams that are not part of a
+    frequent trigram (or bigram) from the cached stem arrays.
+    """
+    def __init__(self, stemmer, stoplist):
+        self.stemmer = stemmer
+        self.stoplist = stoplist
+        self.stem_map = defaultdict(Counter)    # {stem: Counter(gram)}
+        self.trigram_counter = Counter()
+        self.tweets = []    # [([(tokens, stems, stopped)], trigrams)]
+
+    def add(self, tokens):
+        """Add tokens (list of lists, from tokenize) for the next tweet"""
+        self.add_clauses(prepare(tokens, self.stemmer, self.stoplist))
+
+    def add_clauses(self, clauses):
+        """Add clauses (from prepare) for the next tweet"""
+        trigrams = set()
+
+        for words, stems, stopped in clauses:
+            for i in range(len(words) - 2):
+                if stopped[i] or stopped[i+1] or stopped[i+2]:
+                    continue
+                if words[i].startswith('@') or words[i+1].startswith('@') \
+                or words[i+2].startswith('@'):
+                    continue
+                s = (stems[i], stems[i+1], stems[i+2])
+                self.stem_map[s][(words[i], words[i+1], words[i+2])] += 1
+                trigrams.add(s)
+
+        self.trigram_counter.update(trigrams)
+        self.tweets.append((clauses, trigrams))
+
+    def _prune(self, counter):
+        """Ignore grams that only appear in one tweet"""
+        for g, n in list(counter.items()):
+            if n < 2:
+                del counter[g]
+                del self.stem_map[g]
+
+    def finish(self):
+        """
+        Resolve grams for all tweets added
+        @return     ([[stem, ...] per tweet], {stem: [term, ...]})
+        """
+        trigram_counter = self.trigram_counter
+        self._prune(trigram_counter)
+
+        # Bigrams, except those inside a frequent trigram
+        bigram_counter = Counter()
+        tweet_bigrams = []
+
+        for clauses, trigrams in self.tweets:
+            bigrams = set()
+
+            for words, stems, stopped in clauses:
+                last_i = len(words) - 2
+
+                for i in range(len(words) - 1):
+                    if stopped[i] or stopped[i+1]:
+                        continue
+                    if words[i].startswith('@') or words[i+1].startswith('@'):
+                        continue
+                    if i > 0 and \
+                    (stems[i-1], stems[i], stems[i+1]) in trigram_counter:
+                        continue
+                    if i < last_i and \
+                    (stems[i], stems[i+1], stems[i+2]) in trigram_counter:
+                        continue
+                    s = (stems[i], stems[i+1])
+                    self.stem_map[s][(words[i], words[i+1])] += 1
+                    bigrams.add(s)
+
+            tweet_bigrams.append(bigrams)
+            bigram_counter.update(bigrams)
+
+        self._prune(bigram_counter)
+
+        # Unigrams, except those inside a frequent bigram or trigram
+        tweet_stems = []
+
+        for (clauses, trigrams), bigrams in zip(self.tweets, tweet_bigrams):
+            unigrams = set()
+
+            for words, stems, stopped in clauses:
+                last_i = len(words) - 1
+
+                for i in range(len(words)):
+                    if stopped[i]:
+                        continue
+                    if i > 0 and (stems[i-1], stems[i]) in bigram_counter:
+                        continue
+                    if i < last_i and (stems[i], stems[i+1]) in bigram_counter:
+                        continue
+                    if i > 1 and \
+                    (stems[i-2], stems[i-1], stems[i]) in trigram_counter:
+                        continue
+                    if i > 0 and i < last_i and \
+                    (stems[i-1], stems[i], stems[i+1]) in trigram_counter:
+                        continue
+                    if i < (last_i - 1) and \
+                    (stems[i], stems[i+1], stems[i+2]) in trigram_counter:
+                        continue
+                    self.stem_map[(stems[i],)][(words[i],)] += 1
+                    unigrams.add(stems[i])
+
+            stems = list(unigrams)
+            stems.extend([' '.join(x) for x in bigrams if x in bigram_counter])
+            stems.extend([' '.join(x) for x in trigrams if x in trigram_counter])
+            tweet_stems.append(stems)
+
+        stem_map = {}
+        for stem, c in self.stem_map.items():
+            stem_map[' '.join(stem)] = [' '.join(k) for k, v in c.most_common()]
+
+        return (tweet_stems, stem_map)
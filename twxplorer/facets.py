@@ -0,0 +1,208 @@
+"""
+Per-session facet index
+
+The index maps each facet term (stem, hashtag or url) to the ordinals of the
+session tweets that contain it, so filter requests can be answered without
+reading the tweets back out of the database.
+
+Indexes are stored in the facets collection rather than in the session,
+whose document would outgrow mongo's 16MB limit for large sessions, as
+one or more documents per field:
+
+    {'session_id': session_id, 'field': field, 'n': chunk number,
+     'terms': [[term, [ordinal, ...]], ...], 'expires': datetime}
+
+The session records the number of documents (facet_docs), so a partly
+removed index is treated as missing.  Sessions from before this stored
+the index inline, under 'facets'.
+"""
+from collections import Counter, OrderedDict
+import threading
+
+# facet fields, in the order they appear in tweet documents
+FIELDS = ['stems', 'hashtags', 'urls']
+
+# maximum number of session engines kept in memory per process
+ENGINE_CACHE_SIZE = 256
+
+# approximate maximum size of a stored index document
+MAX_DOC_BYTES = 4 * 1024 * 1024
+
+
+def build_index(tweet_list):
+    """
+    Build facet index for tweets, where ordinal = position in tweet_list
+    @return     {field: [[term, [ordinal, ...]], ...]}
+    """
+    index = {}
+    for field in FIELDS:
+        postings = {}
+        for i, tweet in enumerate(tweet_list):
+            for term in tweet[field]:
+                ordinals = postings.setdefault(term, [])
+                if not ordinals or ordinals[-1] != i:
+                    ordinals.append(i)
+        # list of pairs, since urls are not valid mongo keys
+        index[field] = [[term, ordinals] for term, ordinals in postings.items()]
+    return index
+
+
+def save_index(collection, session_id, index, expires=None):
+    """
+    Store facet index for session, to be removed at expires if set
+    @return     number of documents stored
+    """
+    docs = []
+    for field in FIELDS:
+        terms = []
+        size = 0
+        n = 0
+        for term, ordinals in index[field]:
+            # bson array elements take about 12 bytes per ordinal
+            term_size = len(term) + 12 * len(ordinals) + 32
+            if terms and size + term_size > MAX_DOC_BYTES:
+                docs.append({'field': field, 'n': n, 'terms': terms})
+                terms = []
+                size = 0
+                n += 1
+            terms.append([term, ordinals])
+            size += term_size
+        if terms:
+            docs.append({'field': field, 'n': n, 'terms': terms})
+    for doc in docs:
+        doc['session_id'] = session_id
+        if expires is not None:
+            doc['expires'] = expires
+    if docs:
+        collection.insert_many(docs)
+    return len(docs)
+
+
+def load_index(collection, session_id, n_docs):
+    """Load stored facet index for session, or None if incomplete"""
+    index = dict((field, []) for field in FIELDS)
+    n = 0
+    for doc in collection.find({'session_id': session_id},
+    sort=[('field', 1), ('n', 1)]):
+        index[doc['field']].extend(doc['terms'])
+        n += 1
+    if n != n_docs:
+        return None
+    return index
+
+
+def set_expires(collection, session_id, expires):
+    """Set expiry time of stored index, or clear it if expires is None"""
+    if expires is None:
+        update = {'$unset': {'expires': 1}}
+    else:
+        update = {'$set': {'expires': expires}}
+    collection.update_many({'session_id': session_id}, update)
+
+
+def remove_index(collection, session_ids):
+    """Remove stored indexes of sessions, return documents removed"""
+    return collection.delete_many(
+        {'session_id': {'$in': list(session_ids)}}).deleted_count
+
+
+def _ordinals(bits):
+    """Return sorted list of set bit positions"""
+    ordinals = []
+    while bits:
+        low = bits & -bits
+        ordinals.append(low.bit_length() - 1)
+        bits ^= low
+    return ordinals
+
+
+class FacetEngine(object):
+    """
+    Facet index held as one bitmap per term, bit i set = tweet i has term,
+    plus the terms of each tweet, so that co-occurring terms are counted
+    from the matching tweets only
+    """
+    def __init__(self, index):
+        self.bitmaps = {}   # field -> {term: bits}
+        self.terms = {}     # field -> {ordinal: [term, ...]}
+        self.rank = {}      # field -> {term: first-seen position}
+        self.counts = {}    # field -> [(term, count)] in descending order
+        for field in FIELDS:
+            bitmaps = {}
+            terms = {}
+            for term, ordinals in index[field]:
+                bits = 0
+                for i in ordinals:
+                    bits |= 1 << i
+                    terms.setdefault(i, []).append(term)
+                bitmaps[term] = bits
+            self.bitmaps[field] = bitmaps
+            self.terms[field] = terms
+            self.rank[field] = dict((term, i) \
+                for i, (term, ordinals) in enumerate(index[field]))
+            self.counts[field] = self._sorted(
+                [(term, len(ordinals)) for term, ordinals in index[field]],
+                self.rank[field])
+
+    def _sorted(self, pairs, rank):
+        # first-seen order for ties, like Counter.most_common
+        return sorted(pairs, key=lambda x: (-x[1], rank[x[0]]))
+
+    def select(self, filters):
+        """
+        Find tweets matching all filter terms and count co-occurring terms
+        @filters    {field: [term, ...]}
+        @return     (sorted list of matching ordinals or None if unfiltered,
+                    {field: [(term, count), ...] in descending count order})
+        """
+        matched = None
+        for field in FIELDS:
+            bitmaps = self.bitmaps[field]
+            for term in filters.get(field) or []:
+                bits = bitmaps.get(term, 0)
+                matched = bits if matched is None else (matched & bits)
+
+        if matched is not None:
+            matched = _ordinals(matched)
+
+        counts = {}
+        for field in FIELDS:
+            exclude = set(filters.get(field) or [])
+            if matched is None:
+                counts[field] = [x for x in self.counts[field] \
+                    if x[0] not in exclude]
+                continue
+
+            counter = Counter()
+            terms = self.terms[field]
+            for i in matched:
+                counter.update(terms.get(i, ()))
+            counts[field] = self._sorted(
+                [x for x in counter.items() if x[0] not in exclude],
+                self.rank[field])
+
+        return (matched, counts)
+
+
+# session_id -> FacetEngine, most recently used last
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(session_id):
+    """Return cached FacetEngine for session or None"""
+    with _engines_lock:
+        engine = _engines.get(session_id)
+        if engine is not None:
+            _engines.move_to_end(session_id)
+        return engine
+
+
+def set_engine(session_id, index):
+    """Build FacetEngine for session from facet index and cache it"""
+    engine = FacetEngine(index)
+    with _engines_lock:
+        _engines[session_id] = engine
+        while len(_engines) > ENGINE_CACHE_SIZE:
+            _engines.popitem(last=False)
+    return engine
@@ -0,0 +1,144 @@
+"""
+Index registry for the twxplorer database
+
+INDEXES lists every index the app needs, QUERIES the query shapes the app
+issues (with placeholder values), so that indexes.py can create the indexes
+at deploy time and audit the shapes against explain output.  Add both
+when adding a query.
+"""
+import datetime
+import pymongo
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# (collection, keys, options)
+INDEXES = [
+    ('search', [('username', ASC), ('query', ASC)], {}),
+    ('search', [('username', ASC), ('language', ASC), ('query_lower', ASC)],
+        {}),
+    ('search', [('username', ASC), ('language', ASC), ('list_id', ASC)], {}),
+
+    ('session', [('search_id', ASC), ('dt', DESC)], {}),
+    ('session', [('saved', ASC), ('dt', ASC)], {}),
+    ('session', [('expires', ASC)], {'expireAfterSeconds': 0}),
+
+    ('tweets', [('session_id', ASC), ('ordinal', ASC)], {}),
+    ('tweets', [('s', ASC), ('o', ASC)], {}),           # compact storage
+    ('tweets', [('expires', ASC)], {'expireAfterSeconds': 0}),
+    ('tweets', [('x', ASC)], {'expireAfterSeconds': 0}),
+
+    ('tweet_store', [('refs', ASC)], {}),
+
+    ('facets', [('session_id', ASC), ('field', ASC), ('n', ASC)], {}),
+    ('facets', [('expires', ASC)], {'expireAfterSeconds': 0}),
+
+    ('url', [('url', ASC)], {}),
+    ('url', [('aka', ASC)], {}),
+
+    ('list', [('username', ASC)], {}),
+]
+
+_id = '000000000000000000000000'
+_dt = datetime.datetime(2000, 1, 1)
+
+# (collection, where, query, sort)
+QUERIES = [
+    ('search', 'analyze: search by query',
+        {'username': 'u', 'language': 'en', 'query_lower': 'q'}, None),
+    ('search', 'analyze: search by list',
+        {'username': 'u', 'language': 'en', 'list_id': '1'}, None),
+    ('search', 'saved results: searches',
+        {'username': 'u', 'list_id': {'$exists': False}}, [('query', ASC)]),
+
+    ('session', 'saved results: sessions',
+        {'search_id': {'$in': [_id]}, 'saved': 1}, [('dt', DESC)]),
+    ('session', 'analyze: session to refresh',
+        {'search_id': _id, 'status': 'done', 'max_id': {'$exists': True},
+            'storage': {'$in': ['full', 'shared']},
+            'dt': {'$gte': _dt}},
+        [('dt', DESC)]),
+    ('session', 'history_delete: sessions of searches',
+        {'search_id': {'$in': [_id]}}, None),
+    ('session', 'clean: stale sessions',
+        {'saved': {'$ne': 1}, 'dt': {'$lt': _dt}}, None),
+
+    ('tweets', 'filter: tweets by ordinal',
+        {'session_id': _id, 'ordinal': {'$in': [0, 1]}}, [('ordinal', ASC)]),
+    ('tweets', 'filter: tweets by ordinal (compact)',
+        {'s': _id, 'o': {'$in': [0, 1]}}, [('o', ASC)]),
+    ('tweets', 'filter: tweets by terms (sessions without facets)',
+        {'session_id': _id, 'stems': {'$all': ['a']}}, [('ordinal', ASC)]),
+    ('tweets', 'remove tweets of sessions',
+        {'session_id': {'$in': [_id]}}, None),
+    ('tweets', 'remove tweets of sessions (compact)',
+        {'s': {'$in': [_id]}}, None),
+
+    ('tweet_store', 'remove session references',
+        {'refs': {'$in': [_id]}}, None),
+
+    ('facets', 'filter: facet index of session',
+        {'session_id': _id}, [('field', ASC), ('n', ASC)]),
+    ('facets', 'remove facet indexes of sessions',
+        {'session_id': {'$in': [_id]}}, None),
+
+    ('url', 'urls: titles by url or alias',
+        {'$or': [{'url': {'$in': ['u']}}, {'aka': {'$in': ['u']}}]}, None),
+
+    ('list', 'lists: list map', {'username': 'u'}, None),
+]
+
+
+def create_indexes(db):
+    """Create registered indexes (existing ones are left alone)"""
+    for name, keys, options in INDEXES:
+        db[name].create_index(keys, **options)
+
+
+def extra_indexes(db):
+    """
+    Return indexes in the database that are not registered
+    @return     [(collection, index name)]
+    """
+    registered = set()
+    for name, keys, options in INDEXES:
+        registered.add((name, tuple((k, d) for k, d in keys)))
+
+    extra = []
+    for name in sorted(set(x[0] for x in INDEXES)):
+        for index_name, info in db[name].index_information().items():
+            keys = tuple((k, int(d)) for k, d in info['key'])
+            if index_name != '_id_' and (name, keys) not in registered:
+                extra.append((name, index_name))
+    return extra
+
+
+def _scans(plan):
+    """Return True if explain output plan contains a collection scan"""
+    if isinstance(plan, dict):
+        if str(plan.get('cursor', '')).startswith('BasicCursor'):
+            return True     # mongodb < 3.0
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        for k, v in plan.items():
+            if k in ('allPlans', 'rejectedPlans', 'oldPlan'):
+                continue
+            if _scans(v):
+                return True
+    elif isinstance(plan, list):
+        return any(_scans(x) for x in plan)
+    return False
+
+
+def audit(db):
+    """
+    Explain registered query shapes
+    @return     [(collection, where, collection scan?)]
+    """
+    results = []
+    for name, where, query, sort in QUERIES:
+        cursor = db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        results.append((name, where, _scans(cursor.explain())))
+    return results
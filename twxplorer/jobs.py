@@ -0,0 +1,60 @@
+"""
+Background jobs
+
+Jobs run on a fixed number of worker threads fed from a bounded queue.
+The threads are started on first use, i.e. after gunicorn has forked.
+"""
+import queue
+import threading
+import traceback
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue(object):
+    """Run callables on worker threads"""
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work,
+                    name='twxplorer-job-%d' % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            f, args, kwargs = self._queue.get()
+            try:
+                f(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def submit(self, f, *args, **kwargs):
+        """
+        Queue f(*args, **kwargs), or run it now if there are no workers
+        @raise  QueueFull if the queue is full
+        """
+        if not self.workers:
+            f(*args, **kwargs)
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((f, args, kwargs))
+        except queue.Full:
+            raise QueueFull('Too many searches in progress, try again shortly')
+
+    def qsize(self):
+        return self._queue.qsize()
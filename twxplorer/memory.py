@@ -0,0 +1,586 @@
+"""
+In-memory stand-in for the mongo database (DB_ENGINE__DEFAULT=memory)
+
+MemoryClient, MemoryDatabase and MemoryCollection implement the part of
+the pymongo API the app and its scripts use, so connection.py can hand
+out memory collections in place of mongo ones and nothing above it needs
+to know.  It is meant for benchmarks and tests on a single process: the
+data lives in that process only and is gone when it exits.
+
+Documents are stored BSON encoded, and decoded on every read, so callers
+see the same types and copies they would get from mongo (lists for
+tuples, naive datetimes in milliseconds, no shared state with the stored
+document).  Supported:
+
+    query       equality (including array membership), $eq, $ne, $gt,
+                $gte, $lt, $lte, $in, $nin, $all, $exists, $size, $or, $and
+    update      $set, $unset, $inc, $push, $addToSet ($each), $pullAll,
+                $setOnInsert
+    cursor      sort, skip, limit, batch_size, explain
+
+Every query is a scan of the collection, except lookups by _id.  Indexes
+are recorded for index_information() but not used, and TTL indexes do
+not expire documents.
+"""
+import functools
+import threading
+
+import bson
+import pymongo
+import pymongo.errors
+import pymongo.results
+
+
+_missing = object()
+
+
+def _get(doc, path):
+    """Return value at dotted path in doc, or _missing"""
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _missing
+        value = value[part]
+    return value
+
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+#
+# Ordering (mongo compares values of different types by type)
+#
+
+def _rank(value):
+    if value is None or value is _missing:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, bson.ObjectId):
+        return 7
+    return 9        # datetime
+
+
+def _compare(a, b):
+    ra, rb = _rank(a), _rank(b)
+    if ra != rb:
+        return -1 if ra < rb else 1
+    if ra == 1 or a == b:
+        return 0
+    try:
+        return -1 if a < b else 1
+    except TypeError:
+        a, b = str(a), str(b)
+        return (a > b) - (a < b)
+
+
+def _sort_list(docs, sort):
+    """Sort docs in place by [(key, direction)]"""
+    def cmp(a, b):
+        for k, direction in sort:
+            c = _compare(_get(a, k), _get(b, k))
+            if c:
+                return c if direction >= 0 else -c
+        return 0
+    docs.sort(key=functools.cmp_to_key(cmp))
+
+
+#
+# Queries
+#
+
+def _equals(value, arg):
+    if value is _missing:
+        return arg is None
+    if value == arg and _rank(value) == _rank(arg):
+        return True
+    if isinstance(value, list):
+        return any(x == arg and _rank(x) == _rank(arg) for x in value)
+    return False
+
+
+def _compares(value, arg, test):
+    values = value if isinstance(value, list) else [value]
+    return any(_rank(x) == _rank(arg) and test(_compare(x, arg)) \
+        for x in values if x is not _missing)
+
+
+def _match_op(value, op, arg):
+    if op == '$eq':
+        return _equals(value, arg)
+    if op == '$ne':
+        return not _equals(value, arg)
+    if op == '$in':
+        return any(_equals(value, x) for x in arg)
+    if op == '$nin':
+        return not any(_equals(value, x) for x in arg)
+    if op == '$all':
+        return isinstance(value, list) and bool(arg) \
+            and all(_equals(value, x) for x in arg)
+    if op == '$exists':
+        return (value is not _missing) == bool(arg)
+    if op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    if op == '$gt':
+        return _compares(value, arg, lambda c: c > 0)
+    if op == '$gte':
+        return _compares(value, arg, lambda c: c >= 0)
+    if op == '$lt':
+        return _compares(value, arg, lambda c: c < 0)
+    if op == '$lte':
+        return _compares(value, arg, lambda c: c <= 0)
+    raise pymongo.errors.OperationFailure('unknown operator: %s' % op)
+
+
+def _is_operator(cond):
+    return isinstance(cond, dict) and bool(cond) \
+        and all(k.startswith('$') for k in cond)
+
+
+def _match(doc, query):
+    """Return True if doc matches query"""
+    for k, cond in query.items():
+        if k == '$or':
+            if not any(_match(doc, q) for q in cond):
+                return False
+        elif k == '$and':
+            if not all(_match(doc, q) for q in cond):
+                return False
+        elif k.startswith('$'):
+            raise pymongo.errors.OperationFailure(
+                'unknown top level operator: %s' % k)
+        elif _is_operator(cond):
+            value = _get(doc, k)
+            for op, arg in cond.items():
+                if not _match_op(value, op, arg):
+                    return False
+        elif not _equals(_get(doc, k), cond):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    """Apply projection (dict or list of fields) to decoded doc"""
+    if projection is None:
+        return doc
+    if not isinstance(projection, dict):
+        projection = dict((k, 1) for k in projection)
+    if any(v for v in projection.values()):
+        result = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for k, v in projection.items():
+            if v and k != '_id':
+                value = _get(doc, k)
+                if value is not _missing:
+                    _set(result, k, value)
+        return result
+    for k in projection:
+        _unset(doc, k)
+    return doc
+
+
+#
+# Updates
+#
+
+def _apply(doc, update, insert=False):
+    """Apply update operators to doc in place"""
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not insert:
+            continue
+        for k, arg in fields.items():
+            if op in ('$set', '$setOnInsert'):
+                _set(doc, k, arg)
+            elif op == '$unset':
+                _unset(doc, k)
+            elif op == '$inc':
+                value = _get(doc, k)
+                _set(doc, k, arg if value is _missing else value + arg)
+            elif op in ('$push', '$addToSet'):
+                value = _get(doc, k)
+                if value is _missing:
+                    value = []
+                    _set(doc, k, value)
+                items = arg['$each'] if _is_operator(arg) else [arg]
+                for item in items:
+                    if op == '$push' or item not in value:
+                        value.append(item)
+            elif op == '$pullAll':
+                value = _get(doc, k)
+                if isinstance(value, list):
+                    value[:] = [x for x in value if x not in arg]
+            else:
+                raise pymongo.errors.OperationFailure(
+                    'unknown modifier: %s' % op)
+
+
+def _upsert_doc(query):
+    """Return new document seeded with the equality fields of query"""
+    doc = {}
+    for k, cond in query.items():
+        if not k.startswith('$') and not _is_operator(cond):
+            _set(doc, k, cond)
+    return doc
+
+
+class MemoryCursor(object):
+    """Lazily evaluated find() results"""
+    def __init__(self, collection, query, projection=None, sort=None,
+            skip=0, limit=0):
+        self.collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = skip
+        self._limit = limit
+        if sort is not None:
+            self.sort(sort)
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def explain(self):
+        stage = 'IDHACK' if self.collection._by_id(self._query) is not None \
+            else 'COLLSCAN'
+        return {'queryPlanner': {'winningPlan': {'stage': stage}}}
+
+    def __iter__(self):
+        raws = self.collection._select(self._query, self._sort)
+        raws = raws[self._skip:]
+        if self._limit:
+            raws = raws[:abs(self._limit)]
+        for raw in raws:
+            yield _project(bson.decode(raw), self._projection)
+
+
+class MemoryCollection(object):
+    """In-memory collection with the pymongo Collection methods the app uses"""
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._docs = {}         # _id -> (decoded doc, bson)
+        self._indexes = {}      # name -> index_information entry
+        self._exists = False
+
+    @property
+    def full_name(self):
+        return '%s.%s' % (self.database.name, self.name)
+
+    def _by_id(self, query):
+        """Return _ids the query is restricted to, or None"""
+        if not isinstance(query, dict) or '_id' not in query:
+            return None
+        cond = query['_id']
+        if not _is_operator(cond):
+            return [cond]
+        if list(cond) == ['$in']:
+            return list(cond['$in'])
+        return None
+
+    def _find(self, query):
+        """Return [(decoded doc, bson)] matching query, in natural order"""
+        query = query or {}
+        ids = self._by_id(query)
+        if ids is not None:
+            entries = []
+            seen = set()
+            for _id in ids:
+                try:
+                    entry = self._docs.get(_id)
+                except TypeError:
+                    continue        # unhashable, matches nothing stored
+                if entry is not None and _id not in seen:
+                    seen.add(_id)
+                    entries.append(entry)
+        else:
+            entries = self._docs.values()
+        return [x for x in entries if _match(x[0], query)]
+
+    def _select(self, query, sort=None):
+        with self._lock:
+            entries = self._find(query)
+            if sort:
+                docs = [x[0] for x in entries]
+                _sort_list(docs, sort)
+                raws = dict((id(x[0]), x[1]) for x in entries)
+                return [raws[id(doc)] for doc in docs]
+            return [x[1] for x in entries]
+
+    def _store(self, doc, check_keys=False):
+        raw = bson.encode(doc, check_keys=check_keys)
+        self._docs[doc['_id']] = (bson.decode(raw), raw)
+        self._exists = True
+
+    def _insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = bson.ObjectId()
+        if doc['_id'] in self._docs:
+            raise pymongo.errors.DuplicateKeyError(
+                'E11000 duplicate key error collection: %s index: _id_ ' \
+                'dup key: { _id: %r }' % (self.full_name, doc['_id']), 11000)
+        self._store(doc, check_keys=True)
+        return doc['_id']
+
+    #
+    # Queries
+    #
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+            **kwargs):
+        return MemoryCursor(self, filter, projection, sort, skip, limit)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, *args, **kwargs).limit(-1):
+            return doc
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        with self._lock:
+            return len(self._find(filter))
+
+    def distinct(self, key, filter=None, **kwargs):
+        values = []
+        with self._lock:
+            for doc, raw in self._find(filter):
+                value = _get(doc, key)
+                if value is _missing:
+                    continue
+                for x in (value if isinstance(value, list) else [value]):
+                    if x not in values:
+                        values.append(x)
+        return values
+
+    #
+    # Writes
+    #
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return pymongo.results.InsertOneResult(
+                self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        inserted_ids = []
+        errors = []
+        with self._lock:
+            for i, doc in enumerate(documents):
+                try:
+                    inserted_ids.append(self._insert(doc))
+                except pymongo.errors.DuplicateKeyError as e:
+                    errors.append(
+                        {'index': i, 'code': e.code, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if errors:
+            raise pymongo.errors.BulkWriteError({
+                'writeErrors': errors,
+                'writeConcernErrors': [],
+                'nInserted': len(inserted_ids),
+                'nUpserted': 0,
+                'nMatched': 0,
+                'nModified': 0,
+                'nRemoved': 0,
+                'upserted': []
+            })
+        return pymongo.results.InsertManyResult(inserted_ids, True)
+
+    def _update(self, filter, update, upsert, multi, replace=False):
+        if replace and any(k.startswith('$') for k in update):
+            raise ValueError('replacement can not include $ operators')
+        if not replace and not all(k.startswith('$') for k in update):
+            raise ValueError('update only works with $ operators')
+
+        result = {'n': 0, 'nModified': 0, 'updatedExisting': False}
+        with self._lock:
+            entries = self._find(filter)
+            if not multi:
+                entries = entries[:1]
+            for doc, raw in entries:
+                if replace:
+                    new_doc = dict(update)
+                    new_doc['_id'] = doc['_id']
+                else:
+                    new_doc = bson.decode(raw)
+                    _apply(new_doc, update)
+                self._store(new_doc, check_keys=replace)
+                result['n'] += 1
+                if self._docs[doc['_id']][1] != raw:
+                    result['nModified'] += 1
+
+            if entries:
+                result['updatedExisting'] = True
+            elif upsert:
+                if replace:
+                    new_doc = dict(update)
+                    for k, v in _upsert_doc(filter).items():
+                        if k == '_id':
+                            new_doc.setdefault(k, v)
+                else:
+                    new_doc = _upsert_doc(filter)
+                    _apply(new_doc, update, insert=True)
+                result['upserted'] = self._insert(new_doc)
+                result['n'] = 1
+        return pymongo.results.UpdateResult(result, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self._update(filter, replacement, upsert, multi=False,
+            replace=True)
+
+    def _delete(self, filter, multi):
+        with self._lock:
+            entries = self._find(filter)
+            if not multi:
+                entries = entries[:1]
+            for doc, raw in entries:
+                del self._docs[doc['_id']]
+        return pymongo.results.DeleteResult({'n': len(entries)}, True)
+
+    def delete_one(self, filter, **kwargs):
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter, **kwargs):
+        return self._delete(filter, multi=True)
+
+    #
+    # Collection management
+    #
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        name = kwargs.pop('name', None) or \
+            '_'.join('%s_%s' % (k, d) for k, d in keys)
+        with self._lock:
+            info = {'key': list(keys)}
+            info.update(kwargs)
+            self._indexes[name] = info
+            self._exists = True
+        return name
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', pymongo.ASCENDING)]}}
+        with self._lock:
+            info.update(self._indexes)
+        return info
+
+    def stats(self):
+        with self._lock:
+            size = sum(len(raw) for doc, raw in self._docs.values())
+            count = len(self._docs)
+            return {
+                'ns': self.full_name,
+                'count': count,
+                'size': size,
+                'avgObjSize': size // count if count else 0,
+                'nindexes': 1 + len(self._indexes)
+            }
+
+    def drop(self):
+        with self._lock:
+            self._clear()
+
+
+class MemoryDatabase(object):
+    """Named set of memory collections"""
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = \
+                    MemoryCollection(self, name)
+            return collection
+
+    def list_collection_names(self, **kwargs):
+        with self._lock:
+            return sorted(k for k, c in self._collections.items() \
+                if c._exists)
+
+    def drop_collection(self, name):
+        self[name].drop()
+
+    def command(self, command, value=None, **kwargs):
+        if command == 'collstats':
+            if value not in self.list_collection_names():
+                raise pymongo.errors.OperationFailure(
+                    'Collection [%s.%s] not found.' % (self.name, value))
+            return self[value].stats()
+        raise pymongo.errors.OperationFailure(
+            'no such command: %s' % command)
+
+
+class MemoryClient(object):
+    """Process-wide set of memory databases"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._databases = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            db = self._databases.get(name)
+            if db is None:
+                db = self._databases[name] = MemoryDatabase(self, name)
+            return db
+
+    def drop_database(self, name):
+        # existing collection objects stay usable, just empty
+        for collection_name in list(self[name]._collections):
+            self[name].drop_collection(collection_name)
+
+    def close(self):
+        pass
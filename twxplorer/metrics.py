@@ -0,0 +1,199 @@
+"""
+Timing spans and counters for the request hot paths
+
+    with metrics.span('mongo.tweets.insert'):
+        ...
+
+    @metrics.timed('urls.fetch')
+    def fetch(url):
+        ...
+
+    metrics.incr('analyze.tweets', len(tweet_list))
+
+Spans are aggregated into per-name histograms, exposed by snapshot()
+and written to the 'twxplorer.metrics' log every log_interval seconds.
+When disabled, span() returns a shared no-op object and nothing is
+recorded.
+"""
+from functools import wraps
+import json
+import logging
+import threading
+import time
+
+# upper bounds of histogram buckets, in ms
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+    30000, 60000]
+
+enabled = False
+log_interval = 60   # seconds, 0 = never
+
+_logger = logging.getLogger('twxplorer.metrics')
+_lock = threading.Lock()
+_histograms = {}    # name -> Histogram
+_counters = {}      # name -> int
+_last_log = time.time()
+
+
+def configure(enable, interval=60):
+    """Enable or disable recording, set log interval in seconds"""
+    global enabled, log_interval
+    enabled = bool(enable)
+    log_interval = interval
+    if enabled and not _logger.handlers:
+        _logger.addHandler(logging.StreamHandler())
+        _logger.setLevel(logging.INFO)
+
+
+class Histogram(object):
+    """Aggregated durations for one span name"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, p):
+        """Return upper bucket bound containing the p-th percentile"""
+        rank = p / 100.0 * self.count
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= rank and c:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return 0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip([str(x) for x in BUCKETS_MS] + ['inf'],
+                self.buckets))
+        }
+
+
+def record(name, ms):
+    """Record duration in ms for span name"""
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = Histogram()
+        h.add(ms)
+    _maybe_log()
+
+
+def incr(name, n=1):
+    """Increment counter"""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    """Return context manager that times its block as span name"""
+    if not enabled:
+        return _null_span
+    return _Span(name)
+
+
+def timed(name):
+    """Decorator that times each call as span name"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            with _Span(name):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def iterate(name, iterable):
+    """Yield from iterable, timing the total time spent waiting on it"""
+    if not enabled:
+        for x in iterable:
+            yield x
+        return
+    it = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield x
+    finally:
+        record(name, elapsed * 1000)
+
+
+def snapshot():
+    """Return current histograms and counters"""
+    with _lock:
+        return {
+            'spans': dict((k, v.to_dict()) for k, v in _histograms.items()),
+            'counters': dict(_counters)
+        }
+
+
+def reset():
+    """Clear all histograms and counters"""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _maybe_log():
+    global _last_log
+    if not log_interval:
+        return
+    now = time.time()
+    if now - _last_log < log_interval:
+        return
+    _last_log = now
+    _logger.info(json.dumps(snapshot(), sort_keys=True))
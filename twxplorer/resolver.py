@@ -0,0 +1,289 @@
+"""
+Resolve urls to page titles for urls()
+
+Titles are stored in the url collection keyed by the final (post-redirect)
+url, with every url that redirected there listed in 'aka', so shortened
+and tracking variants of a link share one entry and one fetch:
+
+    {'url': final_url, 'title': title, 'aka': [url, ...], 'dt': datetime}
+
+Failed fetches are stored as negative entries and retried after a TTL:
+
+    {'url': url, 'title': '', 'error': message, 'retry_at': datetime}
+
+Fetches run on a bounded thread pool with a per-host concurrency limit:
+fetches beyond a host's limit wait in a per-host queue, not on a pool
+thread, so one busy host does not hold up the others.
+resolve() waits at most until its deadline and returns what it has;
+fetches still running finish in the background and fill the collection
+for the next request.  prefetch() queues urls without waiting, so titles
+are warm by the time the client asks for them.
+"""
+import codecs
+import collections
+import concurrent.futures
+import datetime
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import lxml.etree
+
+from twxplorer import metrics
+
+
+# bytes read per chunk while looking for <title>
+CHUNK_SIZE = 8192
+
+_re_meta_charset = re.compile(
+    br"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.I)
+
+
+def _declared_charset(resp, head):
+    """Return charset from Content-Type header or <meta> in head, or None"""
+    charset = resp.headers.get_content_charset()
+    if not charset:
+        m = _re_meta_charset.search(head)
+        if m:
+            charset = m.group(1).decode('ascii')
+    if charset:
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = None
+    return charset
+
+
+def read_title(resp, max_bytes=262144):
+    """
+    Read title from html response incrementally, stopping once </title>
+    has been parsed or max_bytes have been read
+    """
+    chunk = resp.read(CHUNK_SIZE)
+    charset = _declared_charset(resp, chunk) or 'utf-8'
+    parser = lxml.etree.HTMLPullParser(events=('end',), tag='title',
+        encoding=charset)
+    nread = 0
+    while chunk:
+        nread += len(chunk)
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            return element.text or ''
+        if nread >= max_bytes:
+            break
+        chunk = resp.read(min(CHUNK_SIZE, max_bytes - nread))
+
+    # title left open at end of input
+    try:
+        parser.close()
+    except lxml.etree.LxmlError:
+        return ''
+    for event, element in parser.read_events():
+        return element.text or ''
+    return ''
+
+
+def fetch_title(url, timeout=5, max_bytes=262144):
+    """
+    Fetch url
+    @return (final url after redirects, title or '')
+    """
+    resp = urllib.request.urlopen(url, timeout=timeout)
+    try:
+        final_url = resp.geturl()
+        title = read_title(resp, max_bytes)
+    finally:
+        resp.close()
+    return (final_url, title.strip())
+
+
+class Resolver(object):
+    """Concurrent url -> title resolver backed by a mongo collection"""
+    def __init__(self, collection, workers=8, per_host=2, timeout=5,
+            negative_ttl=3600, max_bytes=262144, max_pending=200,
+            fetch=fetch_title):
+        self.collection = collection
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.fetch = fetch
+        self._executor = None
+        self._lock = threading.Lock()
+        self._hosts = {}        # host -> [running, deque([(url, Future)])]
+        self._inflight = {}     # url -> Future
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+        return self._executor
+
+    def _run(self, host, url, future):
+        """Resolve url on a pool thread, then start the host's next fetch"""
+        try:
+            future.set_result(self._resolve_one(url))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                state = self._hosts[host]
+                if state[1]:
+                    url, future = state[1].popleft()
+                    self._get_executor().submit(self._run, host, url, future)
+                else:
+                    state[0] -= 1
+                    if not state[0]:
+                        del self._hosts[host]  # only busy hosts are kept
+
+    def lookup(self, urls):
+        """
+        Find stored entries for urls, by url or alias
+        @return {url: entry}
+        """
+        if not urls:
+            return {}
+        with metrics.span('mongo.urls.find'):
+            cursor = self.collection.find({'$or': [
+                {'url': {'$in': urls}},
+                {'aka': {'$in': urls}}
+            ]})
+            entries = list(cursor)
+
+        wanted = set(urls)
+        found = {}
+        for r in entries:
+            for url in [r['url']] + r.get('aka', []):
+                if url in wanted:
+                    # prefer successful entries over negative ones
+                    if url not in found or 'error' in found[url]:
+                        found[url] = r
+        return found
+
+    def is_stale(self, r, now=None):
+        """Return True if stored entry r should be fetched again"""
+        if 'error' in r:
+            now = now or datetime.datetime.now()
+            return r.get('retry_at', now) <= now
+        # entries stored before fetch failures were recorded
+        return not r.get('title') and 'dt' not in r
+
+    def submit(self, url):
+        """Queue url for fetching, return future for its entry"""
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is None:
+                future = self._inflight[url] = concurrent.futures.Future()
+                future.add_done_callback(
+                    lambda f, url=url: self._done(url))
+                state = self._hosts.setdefault(host, [0, collections.deque()])
+                if state[0] < self.per_host:
+                    state[0] += 1
+                    self._get_executor().submit(self._run, host, url, future)
+                else:
+                    state[1].append((url, future))
+            return future
+
+    def _done(self, url):
+        with self._lock:
+            self._inflight.pop(url, None)
+
+    def _resolve_one(self, url):
+        """Fetch url and store the result, return stored entry"""
+        now = datetime.datetime.now()
+        try:
+            with metrics.span('urls.fetch'):
+                final_url, title = self.fetch(url, self.timeout,
+                    self.max_bytes)
+        except Exception as e:
+            metrics.incr('urls.fetch.errors')
+            r = {
+                'url': url,
+                'title': '',
+                'error': str(e) or e.__class__.__name__,
+                'retry_at': now + \
+                    datetime.timedelta(seconds=self.negative_ttl)
+            }
+            with metrics.span('mongo.urls.insert'):
+                self.collection.replace_one({'url': url}, r, upsert=True)
+            return r
+
+        update = {
+            '$set': {'title': title, 'dt': now},
+            '$unset': {'error': 1, 'retry_at': 1}
+        }
+        if final_url != url:
+            update['$addToSet'] = {'aka': url}
+        with metrics.span('mongo.urls.insert'):
+            self.collection.update_one({'url': final_url}, update,
+                upsert=True)
+            if final_url != url:
+                # drop negative entry left by an earlier failure
+                self.collection.delete_many(
+                    {'url': url, 'error': {'$exists': True}})
+        return {'url': final_url, 'title': title}
+
+    def prefetch(self, urls):
+        """
+        Queue urls that are not stored (or are stale) for fetching in the
+        background, in the given order.  Stops once max_pending fetches are
+        in flight, so a burst of analyze jobs cannot queue unbounded work.
+        @return number of urls queued
+        """
+        now = datetime.datetime.now()
+        found = self.lookup(list(set(urls)))
+        queued = 0
+        for i, url in enumerate(urls):
+            r = found.get(url)
+            if r is not None and not self.is_stale(r, now):
+                continue
+            if len(self._inflight) >= self.max_pending:
+                metrics.incr('urls.prefetch.dropped', len(urls) - i)
+                break
+            self.submit(url)
+            queued += 1
+        metrics.incr('urls.prefetch.queued', queued)
+        return queued
+
+    def resolve(self, urls, deadline=None):
+        """
+        Get titles for urls, fetching those not already stored
+        @deadline   seconds to wait for fetches (None = until done)
+        @return     [{'url': url, 'title': title}] in the order of urls,
+                    with 'pending': True for fetches still running
+        """
+        start = time.time()
+        now = datetime.datetime.now()
+        found = self.lookup(list(set(urls)))
+
+        futures = {}
+        pending = set()
+        for url in urls:
+            r = found.get(url)
+            if (r is None or self.is_stale(r, now)) and url not in futures:
+                futures[url] = self.submit(url)
+
+        if futures:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - (time.time() - start))
+            done, unused = concurrent.futures.wait(
+                list(futures.values()), timeout=timeout)
+            for url, future in futures.items():
+                if future not in done:
+                    pending.add(url)
+                elif future.exception() is None:
+                    found[url] = future.result()
+
+        info = []
+        for url in urls:
+            r = {'url': url, 'title': found.get(url, {}).get('title', '')}
+            if url in pending:
+                r['pending'] = True
+            info.append(r)
+        return info
@@ -0,0 +1,171 @@
+"""
+Rate limit aware scheduling of tweet fetches for analyze()
+
+All users share the app's rate limit budget per endpoint, and each token
+has its own.  FetchScheduler sits between analyze and the tweet source:
+
+- it tracks the remaining quota per (endpoint, token) from the rate limit
+  headers of the last api response (see sources.TweepySource.read_quota)
+- identical fetches running at the same time are coalesced, the first one
+  pages through the source and the others get the same tweets
+- when the quota runs low, fetches are cut down to low_limit tweets, and
+  never ask for more pages than the quota has left
+- the requests left are split evenly between the fetches queued or running
+  on the same quota, so the first job cannot use up what later ones need
+- a rate limit error (429) mid-fetch keeps the tweets fetched so far, and
+  fails with a readable message if there are none
+
+A source only needs items(limit), plus quota_key and read_quota() to take
+part in quota tracking (FileSource has no quota), so a fake source can
+simulate rate limit headers.
+"""
+import concurrent.futures
+import threading
+import time
+import weakref
+
+import tweepy
+
+from twxplorer import metrics
+
+
+class RateLimited(Exception):
+    """Quota exhausted until reset (epoch seconds)"""
+    def __init__(self, reset):
+        self.reset = reset
+        minutes = max(1, int((reset - time.time()) / 60 + 0.5))
+        super(RateLimited, self).__init__(
+            'Twitter rate limit reached, try again in %d minute%s' % \
+            (minutes, '' if minutes == 1 else 's'))
+
+
+class FetchScheduler(object):
+    """Coalesces fetches and scales them to the remaining quota"""
+    def __init__(self, page_size=100, low_quota=20, low_limit=100):
+        self.page_size = page_size
+        self.low_quota = low_quota      # remaining requests counted as low
+        self.low_limit = low_limit      # tweets per fetch when quota is low
+        self._lock = threading.Lock()
+        self._quota = {}        # quota key -> (remaining, reset)
+        self._inflight = {}     # fetch key -> Future([Status])
+        self._queued = weakref.WeakSet()    # _ScheduledSource not done yet
+
+    def get_quota(self, quota_key):
+        """Return (remaining, reset) for quota key, or None if unknown"""
+        with self._lock:
+            quota = self._quota.get(quota_key)
+            if quota is not None and quota[1] <= time.time():
+                del self._quota[quota_key]
+                quota = None
+            return quota
+
+    def update_quota(self, source):
+        quota_key = getattr(source, 'quota_key', None)
+        if quota_key is None:
+            return
+        quota = source.read_quota()
+        if quota is not None:
+            with self._lock:
+                self._quota[quota_key] = quota
+
+    def share(self, quota_key):
+        """Return number of distinct fetches queued or running on quota key"""
+        with self._lock:
+            keys = set(s.key for s in self._queued \
+                if getattr(s.source, 'quota_key', None) == quota_key)
+        return max(1, len(keys))
+
+    def plan(self, source, limit):
+        """
+        Return number of tweets to fetch from source given its quota
+        @raise  RateLimited if no requests are left
+        """
+        quota_key = getattr(source, 'quota_key', None)
+        quota = self.get_quota(quota_key) if quota_key else None
+        if quota is None:
+            return limit
+
+        remaining, reset = quota
+        if remaining <= 0:
+            raise RateLimited(reset)
+        if remaining < self.low_quota \
+        and (limit is None or limit > self.low_limit):
+            metrics.incr('fetch.degraded')
+            limit = self.low_limit
+        pages = max(1, remaining // self.share(quota_key))
+        if limit is None:
+            return pages * self.page_size
+        return min(limit, pages * self.page_size)
+
+    def source(self, key, source):
+        """
+        Return source whose fetches are scheduled under key, it counts as
+        queued on the quota until its fetch is done (or it is dropped)
+        """
+        scheduled = _ScheduledSource(self, key, source)
+        with self._lock:
+            self._queued.add(scheduled)
+        return scheduled
+
+    def _done(self, scheduled):
+        with self._lock:
+            self._queued.discard(scheduled)
+
+    def items(self, key, source, limit=None):
+        """Yield tweets from source, sharing the fetch with callers of key"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = concurrent.futures.Future()
+
+        if not leader:
+            metrics.incr('fetch.coalesced')
+            for status in future.result()[:limit]:
+                yield status
+            return
+
+        quota_key = getattr(source, 'quota_key', None)
+        statuses = []
+        try:
+            limit = self.plan(source, limit)
+            try:
+                for status in source.items(limit=limit):
+                    self.update_quota(source)
+                    statuses.append(status)
+                    yield status
+            except tweepy.RateLimitError:
+                metrics.incr('fetch.rate_limited')
+                self.update_quota(source)
+                quota = self.get_quota(quota_key) if quota_key else None
+                reset = quota[1] if quota else time.time() + 15 * 60
+                if quota_key is not None:
+                    with self._lock:
+                        self._quota[quota_key] = (0, reset)
+                if not statuses:
+                    raise RateLimited(reset)
+            else:
+                self.update_quota(source)
+        except Exception as e:
+            if not statuses:
+                future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            if not future.done():
+                future.set_result(statuses)
+
+
+class _ScheduledSource(object):
+    def __init__(self, scheduler, key, source):
+        self.scheduler = scheduler
+        self.key = key
+        self.source = source
+
+    def items(self, limit=None):
+        try:
+            for status in self.scheduler.items(self.key, self.source, limit):
+                yield status
+        finally:
+            self.scheduler._done(self)
@@ -0,0 +1,85 @@
+"""
+Tweet sources for analyze()
+
+A source has an items(limit) method, like tweepy.Cursor, that yields
+tweepy Status models for twutil.tweepy_model_to_dict, newest first.
+since_id restricts a source to tweets newer than an earlier fetch.
+"""
+import json
+import tweepy
+
+
+class TweepySource(object):
+    """Tweets from the twitter search api or a list timeline"""
+    def __init__(self, api, query=None, list_id=None, language=None,
+            since_id=None):
+        self.api = api
+        kwargs = {'count': 100, 'include_entities': True}
+        if since_id:
+            kwargs['since_id'] = since_id
+        if query:
+            self.endpoint = '/search/tweets'
+            self.cursor = tweepy.Cursor(api.search, q=query, lang=language, \
+                result_type='recent', **kwargs)
+        elif list_id:
+            self.endpoint = '/lists/statuses'
+            self.cursor = tweepy.Cursor(api.list_timeline, list_id=list_id, \
+                **kwargs)
+        else:
+            raise Exception('No query or list specified')
+
+    @property
+    def quota_key(self):
+        """Rate limits are per endpoint and access token"""
+        return (self.endpoint, getattr(self.api.auth, 'access_token', None))
+
+    def read_quota(self):
+        """
+        Return (remaining requests, reset time) from the last response's
+        rate limit headers, or None
+        """
+        resp = getattr(self.api, 'last_response', None)
+        if resp is None:
+            return None
+        try:
+            return (int(resp.headers['x-rate-limit-remaining']),
+                int(resp.headers['x-rate-limit-reset']))
+        except (KeyError, ValueError):
+            return None
+
+    def items(self, limit=None):
+        return self.cursor.items(limit=limit)
+
+
+class FileSource(object):
+    """
+    Tweets replayed from a JSONL file, one twitter api status object per
+    line, e.g. as written by write_statuses
+    """
+    quota_key = None
+
+    def __init__(self, path, since_id=None):
+        self.path = path
+        self.since_id = int(since_id) if since_id else None
+
+    def items(self, limit=None):
+        n = 0
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if limit is not None and n >= limit:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                status = json.loads(line)
+                if self.since_id and int(status['id_str']) <= self.since_id:
+                    continue
+                yield tweepy.models.Status.parse(None, status)
+                n += 1
+
+
+def write_statuses(path, statuses):
+    """Write status dicts (raw twitter api json) to a JSONL file"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for status in statuses:
+            f.write(json.dumps(status)+'\n')
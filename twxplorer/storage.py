@@ -0,0 +1,264 @@
+"""
+Tweet storage formats for the tweets collection
+
+full        tweepy_model_to_dict output plus the derived fields (default)
+compact     only the fields the app reads, under short keys:
+
+    s   session_id              c   created_at
+    o   ordinal                 e   embed
+    i   id_str                  st  stems
+    un  user.name               h   hashtags
+    us  user.screen_name        u   urls
+    rt  retweeted_status.id_str x   expires
+
+shared      one document per tweet in the tweet_store collection, keyed by
+            id_str and shared by every session that fetched it.  It holds
+            the compact display fields plus the extraction results that do
+            not depend on the session, so a re-seen tweet is neither
+            re-formatted nor re-tokenized or re-stemmed:
+
+    _id     id_str
+    tk      tokens
+    sm      {language: stems per clause}
+    refs    ids of sessions referencing the tweet
+
+            The session keeps the tweet ids in fetch order (tweet_ids) and
+            its own derived fields (n-gram stems, hashtags) in its facet
+            index (see facets.py).
+            Tweets are removed with the last session referencing them,
+            and have no expiry time of their own (see clean.py).
+
+Retweets keep only the id of the original tweet (rt), which is all filter()
+needs to collapse them.  Each session records the format its tweets were
+stored in (session_r['storage'], missing = full), so all kinds can live in
+the database at once; see migrate.py to convert existing sessions.
+"""
+import pymongo.errors
+
+FULL = 'full'
+COMPACT = 'compact'
+SHARED = 'shared'
+
+# session fields not stored with shared tweets
+_session_keys = ['s', 'o', 'i', 'st', 'h']
+
+# long field name -> compact key
+_keys = {
+    'session_id': 's',
+    'ordinal': 'o',
+    'id_str': 'i',
+    'created_at': 'c',
+    'embed': 'e',
+    'stems': 'st',
+    'hashtags': 'h',
+    'urls': 'u',
+    'user.name': 'un',
+    'user.screen_name': 'us',
+    'retweeted_status.id_str': 'rt',
+    'expires': 'x'
+}
+_names = dict((v, k) for k, v in _keys.items())
+
+
+def get_storage(session_r):
+    """Return storage format of session tweets"""
+    return session_r.get('storage', FULL)
+
+
+def key(name, storage):
+    """Return stored field name for name"""
+    if storage == COMPACT:
+        return _keys.get(name, name)
+    return name
+
+
+def query(params, storage):
+    """Translate query (or projection) keys to storage"""
+    return dict((key(k, storage), v) for k, v in params.items())
+
+
+def pack(tweet, storage):
+    """Return document to store for tweet dict"""
+    if storage != COMPACT:
+        return tweet
+    doc = {}
+    for name, k in _keys.items():
+        value = tweet
+        for part in name.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if value is not None:
+            doc[k] = value
+    return doc
+
+
+def unpack(doc, storage):
+    """Return stored document with long (full format) field names"""
+    if storage != COMPACT:
+        return doc
+    tweet = {}
+    for k, value in doc.items():
+        name = _names.get(k, k)
+        if '.' in name:
+            parent, child = name.split('.')
+            tweet.setdefault(parent, {})[child] = value
+        else:
+            tweet[name] = value
+    return tweet
+
+
+def find(collection, session_id, storage, params=None, fields=None,
+        sort=None):
+    """Find tweets for session, return list of unpacked tweet dicts"""
+    q = {'session_id': session_id}
+    q.update(params or {})
+    if fields is not None:
+        fields = query(fields, storage)
+    if sort is not None:
+        sort = [(key(k, storage), d) for k, d in sort]
+    cursor = collection.find(query(q, storage), fields, sort=sort)
+    return [unpack(doc, storage) for doc in cursor]
+
+
+def insert(collection, tweet_list, storage, expires=None):
+    """
+    Store tweets for session, to be removed at expires if set (any expiry
+    time the tweet dicts carry, e.g. from a refreshed session, is replaced)
+    """
+    docs = [pack(tweet, storage) for tweet in tweet_list]
+    k = key('expires', storage)
+    for doc in docs:
+        if expires is None:
+            doc.pop(k, None)
+        else:
+            doc[k] = expires
+    if docs:
+        collection.insert_many(docs, ordered=False)
+
+
+def set_expires(collection, session_id, storage, expires):
+    """Set expiry time of session tweets, or clear it if expires is None"""
+    if storage == SHARED:
+        return
+    k = key('expires', storage)
+    if expires is None:
+        update = {'$unset': {k: 1}}
+    else:
+        update = {'$set': {k: expires}}
+    collection.update_many(query({'session_id': session_id}, storage), update)
+
+
+def load_memo(store, tweet_list, language):
+    """
+    Look up shared tweets, setting embed on those already stored
+    @return     (tokens, stems for language or None) or None per tweet,
+                see backends.extract_batch
+    """
+    ids = [tweet['id_str'] for tweet in tweet_list]
+    cursor = store.find({'_id': {'$in': ids}},
+        {'e': 1, 'tk': 1, 'sm.'+language: 1})
+    docs = dict((doc['_id'], doc) for doc in cursor)
+
+    memo = []
+    for tweet in tweet_list:
+        doc = docs.get(tweet['id_str'])
+        if doc is None:
+            memo.append(None)
+        else:
+            tweet['embed'] = doc['e']
+            memo.append((doc['tk'], doc.get('sm', {}).get(language)))
+    return memo
+
+
+def pack_shared(tweet, session_id, language, stems):
+    """Return shared store document for tweet"""
+    doc = pack(tweet, COMPACT)
+    for k in _session_keys:
+        doc.pop(k, None)
+    doc['_id'] = tweet['id_str']
+    doc['tk'] = tweet['tokens']
+    doc['sm'] = {language: stems}
+    doc['refs'] = [session_id]
+    return doc
+
+
+def save_shared(store, session_id, language, items):
+    """
+    Store tweets for session in the shared store
+    @items      [(tweet, memo entry from load_memo, stems per clause)]
+    """
+    new_docs = []
+    for tweet, m, stems in items:
+        if m is None:
+            new_docs.append(pack_shared(tweet, session_id, language, stems))
+        elif m[1] is None:
+            store.update_one({'_id': tweet['id_str']},
+                {'$set': {'sm.'+language: stems}})
+    if new_docs:
+        try:
+            store.insert_many(new_docs, ordered=False)
+        except pymongo.errors.BulkWriteError:
+            pass    # stored meanwhile by another session
+
+    ids = list(set(tweet['id_str'] for tweet, m, stems in items))
+    store.update_many({'_id': {'$in': ids}},
+        {'$addToSet': {'refs': session_id}})
+
+    # re-store tweets removed by a concurrent delete since load_memo
+    stored = set(doc['_id'] for doc in store.find(
+        {'_id': {'$in': ids}, 'refs': session_id}, {'_id': 1}))
+    missing = dict((tweet['id_str'], (tweet, stems)) \
+        for tweet, m, stems in items if tweet['id_str'] not in stored)
+    if missing:
+        try:
+            store.insert_many([pack_shared(tweet, session_id, language, stems) \
+                for tweet, stems in missing.values()], ordered=False)
+        except pymongo.errors.BulkWriteError:
+            store.update_many({'_id': {'$in': list(missing)}},
+                {'$addToSet': {'refs': session_id}})
+
+
+def find_shared(store, tweet_ids, ordinals=None):
+    """
+    Find shared tweets by ordinal in session tweet_ids
+    @return     list of unpacked tweet dicts in ordinal order
+    """
+    if ordinals is None:
+        ordinals = range(len(tweet_ids))
+    ids = [tweet_ids[o] for o in ordinals]
+    cursor = store.find({'_id': {'$in': list(set(ids))}},
+        {'tk': 0, 'sm': 0, 'refs': 0})
+    docs = dict((doc['_id'], doc) for doc in cursor)
+
+    tweet_list = []
+    for o, id_str in zip(ordinals, ids):
+        doc = docs.get(id_str)
+        if doc is not None:
+            tweet = unpack(doc, COMPACT)
+            tweet['id_str'] = id_str
+            tweet['ordinal'] = o
+            tweet_list.append(tweet)
+    return tweet_list
+
+
+def remove_session(collection, session_ids, store=None):
+    """
+    Remove tweets of sessions in any storage format, and shared tweets
+    in store no longer referenced by any session
+    @return     (tweets removed, shared tweets removed)
+    """
+    session_ids = list(session_ids)
+    removed = collection.delete_many(
+        {'session_id': {'$in': session_ids}}).deleted_count
+    removed += collection.delete_many(
+        {'s': {'$in': session_ids}}).deleted_count
+
+    removed_shared = 0
+    if store is not None:
+        ids = [doc['_id'] for doc in \
+            store.find({'refs': {'$in': session_ids}}, {'_id': 1})]
+        if ids:
+            store.update_many({'_id': {'$in': ids}},
+                {'$pullAll': {'refs': session_ids}})
+            removed_shared = store.delete_many(
+                {'_id': {'$in': ids}, 'refs': {'$size': 0}}).deleted_count
+    return (removed, removed_shared)
@@ -5,6 +5,8 @@ import datetime
 import re
 import tweepy
 
+from twxplorer import metrics
+
 def tweepy_model_to_dict(status_obj):
     """Convert a tweepy status object to a dictionary""" 
     d = {}
@@ -17,6 +19,7 @@ def tweepy_model_to_dict(status_obj):
             d[key] = value    
     return d
 
+@metrics.timed('twutil.format_text')
 def format_text(tweet_dict):
     """Return formatted version of tweet text"""
     text = tweet_dict['text']